@@ -4,40 +4,156 @@
 Обработчики команд и сообщений Telegram бота
 """
 
+import asyncio
+import functools
 import logging
-import json
+import re
+import weakref
+from collections import namedtuple
+from types import MappingProxyType
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram import Update
 from telegram.ext import ContextTypes
 from telegram.error import BadRequest
 
-from config import MESSAGES, BOOKS_PER_PAGE
-from database.db import (
-    add_or_update_user, get_user_books, add_book_to_global, 
-    add_book_to_user_library, remove_book_from_user_library,
-    update_user_book_rating, search_books_in_db, get_book_by_id,
+from config import (
+    MESSAGES, BOOKS_PER_PAGE, SEARCH_RESULTS_PER_PAGE, RECOMMENDATIONS_CACHE_TTL,
+    WIZARD_STATE_TTL, WIZARD_STATE_MAX_USERS
+)
+from database.async_db import (
+    add_or_update_user, get_user_books_page, get_user_books_count,
+    add_book_and_check, add_new_book_to_user_library,
+    remove_book_from_user_library,
+    rate_user_book, search_books_in_db,
     set_user_state, get_user_state, clear_user_state,
     check_book_in_user_library
 )
-from services.openlibrary import openlibrary_api
 from services.recommendations import recommendation_system
 from services.book_sources import book_source_manager
 from bot.keyboards import (
     get_main_menu_keyboard, get_add_book_keyboard, get_library_menu_keyboard,
-    get_sort_keyboard, get_book_actions_keyboard, get_search_results_keyboard,
-    get_pagination_keyboard, get_confirmation_keyboard, get_rating_keyboard,
-    get_cancel_keyboard, get_recommendations_keyboard, get_book_detail_keyboard,
-    get_book_sources_keyboard
+    get_sort_keyboard, get_search_results_keyboard, get_confirmation_keyboard,
+    get_rating_keyboard, get_cancel_keyboard, get_recommendations_keyboard,
+    get_book_sources_keyboard, get_button
 )
 from utils.validators import validate_rating, validate_text_length
+from utils.cache import TTLCache
+from utils.formatting import add_display_fields
 
 logger = logging.getLogger(__name__)
 
+# Описание источника: эмодзи, название для сообщения о выборе и для заголовка результатов
+SourceInfo = namedtuple('SourceInfo', 'emoji name short')
+
+SOURCES: dict[str, SourceInfo] = {
+    'openlibrary': SourceInfo('📚', 'Open Library', 'Open Library'),
+    'googlebooks': SourceInfo('📖', 'Google Books', 'Google Books'),
+    'loc': SourceInfo('🏛️', 'Library of Congress', 'Library of Congress'),
+    'isbndb': SourceInfo('📘', 'ISBNDB', 'ISBNDB'),
+    'all': SourceInfo('🔍', 'Все источники', 'Все источники')
+}
+
+# Названия критериев сортировки библиотеки
+SORT_NAMES = MappingProxyType({
+    'date_added': 'дате добавления',
+    'title': 'названию',
+    'author': 'автору',
+    'genre': 'жанру',
+    'rating': 'оценке'
+})
+
+# Постоянные кнопки под списком книг библиотеки
+LIBRARY_CONTROL_ROWS = (
+    (InlineKeyboardButton("🔤 Сортировка", callback_data="library_sort"),),
+    (InlineKeyboardButton("🔙 Назад", callback_data="my_library"),)
+)
+
+# Пояснения к типам рекомендаций
+REC_TYPE_LABEL = {
+    'genre_based': "🎯 На основе ваших предпочтений по жанрам\n",
+    'content_based': "🎯 Похожа на ваши любимые книги\n",
+    'popular': "🎯 Популярная книга\n"
+}
+
+# Данные незавершенного ручного добавления книги: {user_id: {'step': ..., 'data': {...}}}.
+# Промежуточные шаги хранятся в памяти, в базу попадает только готовая книга.
+# Обработчики выполняются параллельно (block=False), поэтому общее состояние
+# модуля всегда ключуется по user_id. Брошенный ввод истекает через WIZARD_STATE_TTL
+# после последнего шага, а число записей ограничено
+WIZARD_STATE = TTLCache(maxsize=WIZARD_STATE_MAX_USERS, ttl=WIZARD_STATE_TTL)
+
+# Недавно рассчитанные рекомендации: {user_id: [книги]}
+_REC_CACHE = TTLCache(maxsize=10000, ttl=RECOMMENDATIONS_CACHE_TTL)
+
+# Блокировки пользователей: {user_id: asyncio.Lock}. Запись живет, пока блокировку кто-то держит или ждет
+_user_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+def per_user_lock(handler):
+    """Последовательная обработка обновлений одного пользователя.
+
+    Обработчики запускаются с block=False, поэтому обновления разных пользователей
+    обрабатываются параллельно; обновления одного пользователя ждут друг друга,
+    чтобы быстрые повторные нажатия не перемешивали правки одного сообщения.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        user = update.effective_user
+        if user is None:
+            return await handler(update, context, *args, **kwargs)
+        
+        lock = _user_locks.get(user.id)
+        if lock is None:
+            lock = _user_locks[user.id] = asyncio.Lock()
+        async with lock:
+            return await handler(update, context, *args, **kwargs)
+    return wrapper
+
+async def _edit_message(query, text: str, reply_markup=None, **kwargs):
+    """Редактирование сообщения callback-запроса без лишних запросов к API.
+
+    Если текст и клавиатура не изменились (повторное нажатие той же кнопки),
+    Telegram всё равно ответил бы BadRequest «message is not modified».
+    """
+    message = query.message
+    if message is not None and message.reply_markup == reply_markup:
+        # message.text хранит уже отрисованный текст без разметки, поэтому текст с Markdown
+        # сравнивается с разметкой, восстановленной из entities сообщения
+        if kwargs.get('parse_mode') == 'Markdown':
+            current_text = message.text_markdown
+        else:
+            current_text = message.text
+        if current_text == text:
+            return
+    await query.edit_message_text(text, reply_markup=reply_markup, **kwargs)
+
+async def _set_state(user_id: int, state: str, data: str = None):
+    """Установка состояния диалога с прерыванием ручного добавления книги"""
+    WIZARD_STATE.pop(user_id, None)
+    await set_user_state(user_id, state, data)
+
+async def _clear_state(user_id: int):
+    """Сброс состояния диалога, включая ручное добавление книги"""
+    WIZARD_STATE.pop(user_id, None)
+    await clear_user_state(user_id)
+
+async def _get_recommendations(user_id: int, refresh: bool = False):
+    """Рекомендации пользователя из кэша или заново рассчитанные"""
+    if refresh:
+        _REC_CACHE.pop(user_id, None)
+    
+    recommendations = _REC_CACHE.get(user_id)
+    if recommendations is None:
+        recommendations = await recommendation_system.get_recommendations(user_id)
+        for book in recommendations:
+            add_display_fields(book)
+        _REC_CACHE[user_id] = recommendations
+    return recommendations
+
+@per_user_lock
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
     try:
         user = update.effective_user
-        add_or_update_user(user.id, user.username, user.first_name, user.last_name)
+        await add_or_update_user(user.id, user.username, user.first_name, user.last_name)
         
         await update.message.reply_text(
             MESSAGES['start'],
@@ -48,6 +164,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка в start: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
+@per_user_lock
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
     try:
@@ -59,6 +176,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка в help_command: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
+@per_user_lock
 async def add_book_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /add"""
     try:
@@ -70,13 +188,14 @@ async def add_book_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка в add_book_command: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
+@per_user_lock
 async def my_library_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /library"""
     try:
         user_id = update.effective_user.id
-        books = get_user_books(user_id)
+        books_count = await get_user_books_count(user_id)
         
-        if not books:
+        if not books_count:
             await update.message.reply_text(
                 MESSAGES['empty_library'],
                 reply_markup=get_main_menu_keyboard()
@@ -84,7 +203,7 @@ async def my_library_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
         
         await update.message.reply_text(
-            f"📚 Ваша библиотека ({len(books)} книг):",
+            f"📚 Ваша библиотека ({books_count} книг):",
             reply_markup=get_library_menu_keyboard()
         )
         
@@ -92,11 +211,12 @@ async def my_library_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"Ошибка в my_library_command: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
+@per_user_lock
 async def recommendations_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /recommendations"""
     try:
         user_id = update.effective_user.id
-        recommendations = recommendation_system.get_recommendations(user_id)
+        recommendations = await _get_recommendations(user_id)
         
         if not recommendations:
             await update.message.reply_text(
@@ -106,27 +226,21 @@ async def recommendations_command(update: Update, context: ContextTypes.DEFAULT_
             return
         
         # Показываем первые 3 рекомендации
-        message = "✨ Рекомендации для вас:\n\n"
+        parts = ["✨ Рекомендации для вас:\n\n"]
         
         for i, book in enumerate(recommendations[:3], 1):
-            message += f"{i}. 📖 *{book['title']}*\n"
-            message += f"👤 Автор: {book['author']}\n"
+            parts.append(f"{i}. 📖 *{book['title_md']}*\n")
+            parts.append(f"👤 Автор: {book['author_md']}\n")
             
             if book.get('genre'):
-                message += f"📂 Жанр: {book['genre']}\n"
+                parts.append(f"📂 Жанр: {book['genre_md']}\n")
             
-            rec_type = book.get('recommendation_type', 'unknown')
-            if rec_type == 'genre_based':
-                message += "🎯 На основе ваших предпочтений по жанрам\n"
-            elif rec_type == 'content_based':
-                message += "🎯 Похожа на ваши любимые книги\n"
-            elif rec_type == 'popular':
-                message += "🎯 Популярная книга\n"
+            parts.append(REC_TYPE_LABEL.get(book.get('recommendation_type'), ''))
             
-            message += "\n"
+            parts.append("\n")
         
         await update.message.reply_text(
-            message,
+            ''.join(parts),
             parse_mode='Markdown',
             reply_markup=get_recommendations_keyboard()
         )
@@ -135,11 +249,12 @@ async def recommendations_command(update: Update, context: ContextTypes.DEFAULT_
         logger.error(f"Ошибка в recommendations_command: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
+@per_user_lock
 async def search_books_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /search"""
     try:
         user_id = update.effective_user.id
-        set_user_state(user_id, 'waiting_search_query')
+        await _set_state(user_id, 'waiting_search_query')
         
         await update.message.reply_text(
             MESSAGES['enter_search_query'],
@@ -150,11 +265,12 @@ async def search_books_command(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"Ошибка в search_books_command: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
+@per_user_lock
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /cancel"""
     try:
         user_id = update.effective_user.id
-        clear_user_state(user_id)
+        await _clear_state(user_id)
         
         await update.message.reply_text(
             MESSAGES['cancel'],
@@ -165,18 +281,22 @@ async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка в cancel_command: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
+@per_user_lock
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик текстовых сообщений"""
     try:
         user_id = update.effective_user.id
         text = update.message.text.strip()
         
-        state, data = get_user_state(user_id)
+        wizard_state = WIZARD_STATE.get(user_id)
+        if wizard_state is not None:
+            await handle_manual_book_data(update, context, text, wizard_state)
+            return
+        
+        state, data = await get_user_state(user_id)
         
         if state == 'waiting_search_query':
             await handle_search_query(update, context, text)
-        elif state == 'adding_manual_book':
-            await handle_manual_book_data(update, context, text, data)
         elif state == 'waiting_rating':
             await handle_rating_input(update, context, text, data)
         else:
@@ -194,25 +314,25 @@ async def handle_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE
     """Обработка поискового запроса"""
     try:
         user_id = update.effective_user.id
-        clear_user_state(user_id)
+        await clear_user_state(user_id)
         
         # Получаем выбранный источник
         selected_source = context.user_data.get('selected_source', 'openlibrary')
         
         # Ищем сначала в локальной базе
-        local_books = search_books_in_db(query, limit=3)
+        local_books = await search_books_in_db(query, limit=3)
         
         # Ищем в выбранных источниках
         external_books = []
         
         if selected_source == 'all':
             # Поиск во всех источниках
-            all_results = book_source_manager.search_in_all_sources(query, limit_per_source=3)
-            for source_id, books in all_results.items():
-                external_books.extend(books)
+            all_results = await book_source_manager.search_in_all_sources(query, limit_per_source=3)
+            # Одна и та же книга из разных источников показывается один раз
+            external_books = book_source_manager.merge_results(all_results)
         else:
             # Поиск в конкретном источнике
-            external_books = book_source_manager.search_in_source(selected_source, query, limit=5)
+            external_books = await book_source_manager.search_in_source(selected_source, query, limit=5)
         
         if not local_books and not external_books:
             await update.message.reply_text(
@@ -221,63 +341,60 @@ async def handle_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE
             )
             return
         
-        # Сохраняем результаты поиска в контексте
+        for book in external_books:
+            add_display_fields(book)
+        
+        # Сохраняем результаты поиска в контексте. В глобальную базу книга попадает только
+        # при выборе (_present_search_result), а не каждый найденный результат
         context.user_data['search_results'] = external_books
+        context.user_data['search_results_ids'] = {}
+        # Индексы результатов по внешнему ID для кнопок db_book_; при повторах ID, как и при
+        # прежнем линейном поиске, выбирается первый результат
+        search_results_by_eid = {}
+        for i, b in enumerate(external_books):
+            if b.get('external_id'):
+                search_results_by_eid.setdefault(b['external_id'], i)
+        context.user_data['search_results_by_eid'] = search_results_by_eid
         context.user_data['local_results'] = local_books
         context.user_data['search_query'] = query
         
-        message = f"🔍 Результаты поиска по запросу '{query}':\n\n"
+        parts = [f"🔍 Результаты поиска по запросу '{query}':\n\n"]
         
         if local_books:
-            message += "📚 Из вашей базы данных:\n"
+            parts.append("📚 Из вашей базы данных:\n")
             for i, book in enumerate(local_books, 1):
-                message += f"{i}. {book['title']} - {book['author']}\n"
-            message += "\n"
+                parts.append(f"{i}. {book['title']} - {book['author']}\n")
+            parts.append("\n")
         
         if external_books:
-            source_names = {
-                'openlibrary': 'Open Library',
-                'googlebooks': 'Google Books',
-                'loc': 'Library of Congress',
-                'isbndb': 'ISBNDB'
-            }
-            
             if selected_source == 'all':
-                message += "🌐 Из внешних источников:\n"
+                parts.append("🌐 Из внешних источников:\n")
             else:
-                source_name = source_names.get(selected_source, 'выбранного источника')
-                message += f"🌐 Из {source_name}:\n"
+                source = SOURCES.get(selected_source)
+                source_name = source.short if source else 'выбранного источника'
+                parts.append(f"🌐 Из {source_name}:\n")
+            
+            # Первая страница результатов, остальные листаются через search_page_
+            total_pages = (len(external_books) + SEARCH_RESULTS_PER_PAGE - 1) // SEARCH_RESULTS_PER_PAGE
             
             await update.message.reply_text(
-                message,
-                reply_markup=get_search_results_keyboard(external_books, 0, selected_source)
+                ''.join(parts),
+                reply_markup=get_search_results_keyboard(
+                    external_books[:SEARCH_RESULTS_PER_PAGE], 0, total_pages, selected_source
+                )
             )
         else:
-            await update.message.reply_text(message)
+            await update.message.reply_text(''.join(parts))
         
     except Exception as e:
         logger.error(f"Ошибка в handle_search_query: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
-async def handle_manual_book_data(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, data: str):
+async def handle_manual_book_data(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, state_data: dict):
     """Обработка ручного ввода данных книги"""
     try:
         user_id = update.effective_user.id
         
-        if not data:
-            # Начинаем сбор данных - запрашиваем название
-            set_user_state(user_id, 'adding_manual_book', json.dumps({'step': 'title', 'data': {}}))
-            await update.message.reply_text(
-                "📖 Введите название книги:",
-                reply_markup=get_cancel_keyboard()
-            )
-            return
-        
-        try:
-            state_data = json.loads(data)
-        except json.JSONDecodeError:
-            state_data = {'step': 'title', 'data': {}}
-        
         step = state_data.get('step')
         book_data = state_data.get('data', {})
         
@@ -287,8 +404,7 @@ async def handle_manual_book_data(update: Update, context: ContextTypes.DEFAULT_
                 return
             
             book_data['title'] = text
-            set_user_state(user_id, 'adding_manual_book', 
-                         json.dumps({'step': 'author', 'data': book_data}))
+            WIZARD_STATE[user_id] = {'step': 'author', 'data': book_data}
             await update.message.reply_text("👤 Введите автора книги:")
             
         elif step == 'author':
@@ -297,8 +413,7 @@ async def handle_manual_book_data(update: Update, context: ContextTypes.DEFAULT_
                 return
             
             book_data['author'] = text
-            set_user_state(user_id, 'adding_manual_book', 
-                         json.dumps({'step': 'genre', 'data': book_data}))
+            WIZARD_STATE[user_id] = {'step': 'genre', 'data': book_data}
             await update.message.reply_text("📂 Введите жанр книги:")
             
         elif step == 'genre':
@@ -307,8 +422,7 @@ async def handle_manual_book_data(update: Update, context: ContextTypes.DEFAULT_
                 return
             
             book_data['genre'] = text
-            set_user_state(user_id, 'adding_manual_book', 
-                         json.dumps({'step': 'description', 'data': book_data}))
+            WIZARD_STATE[user_id] = {'step': 'description', 'data': book_data}
             await update.message.reply_text("📝 Введите краткое описание книги:")
             
         elif step == 'description':
@@ -317,8 +431,7 @@ async def handle_manual_book_data(update: Update, context: ContextTypes.DEFAULT_
                 return
             
             book_data['description'] = text
-            set_user_state(user_id, 'adding_manual_book', 
-                         json.dumps({'step': 'rating', 'data': book_data}))
+            WIZARD_STATE[user_id] = {'step': 'rating', 'data': book_data}
             await update.message.reply_text("⭐ Введите вашу оценку книги (от 1 до 10):")
             
         elif step == 'rating':
@@ -329,17 +442,11 @@ async def handle_manual_book_data(update: Update, context: ContextTypes.DEFAULT_
             
             book_data['rating'] = rating
             
-            # Добавляем книгу в базу
-            book_id = add_book_to_global(
-                title=book_data['title'],
-                author=book_data['author'],
-                genre=book_data['genre'],
-                description=book_data['description']
-            )
-            
-            add_book_to_user_library(user_id, book_id, rating)
+            # Добавляем книгу в базу и в библиотеку одним обращением
+            await add_new_book_to_user_library(user_id, book_data, rating)
             
-            clear_user_state(user_id)
+            WIZARD_STATE.pop(user_id, None)
+            _REC_CACHE.pop(user_id, None)
             
             await update.message.reply_text(
                 MESSAGES['book_added'],
@@ -361,12 +468,15 @@ async def handle_rating_input(update: Update, context: ContextTypes.DEFAULT_TYPE
             return
         
         book_id = int(data)
-        update_user_book_rating(user_id, book_id, rating)
+        # Оценка вводится при добавлении книги: вставляем ее в библиотеку, а если она
+        # там уже есть, только обновляем оценку
+        added = await rate_user_book(user_id, book_id, rating)
+        _REC_CACHE.pop(user_id, None)
         
-        clear_user_state(user_id)
+        await clear_user_state(user_id)
         
         await update.message.reply_text(
-            MESSAGES['book_updated'],
+            MESSAGES['book_added'] if added else MESSAGES['book_updated'],
             reply_markup=get_main_menu_keyboard()
         )
         
@@ -374,437 +484,408 @@ async def handle_rating_input(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Ошибка в handle_rating_input: {e}")
         await update.message.reply_text(MESSAGES['error'])
 
-async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик callback запросов от inline клавиатур"""
-    logger.info(f"Callback получен: {update.callback_query.data} от {update.callback_query.from_user.id}")
+async def _present_search_result(query, context, user_id: int, book_index: int):
+    """Выбор результата поиска: книга сохраняется в глобальной базе и проверяется
+    по библиотеке пользователя за одно обращение к базе"""
+    book_ids = context.user_data.setdefault('search_results_ids', {})
+    selected_book = context.user_data['search_results'][book_index]
+    # При повторном выборе ID уже известен, и книга без внешнего ID не вставляется снова
+    book_id, in_library = await add_book_and_check(user_id, selected_book, book_ids.get(book_index))
+    book_ids[book_index] = book_id
+    await _present_book_for_rating(query, selected_book, book_id, in_library)
+
+async def _present_book_for_rating(query, selected_book: dict, book_id: int, in_library: bool):
+    """Предложение оценить найденную книгу, уже сохраненную в глобальной базе"""
+    if in_library:
+        await _edit_message(
+            query,
+            "📚 Эта книга уже есть в вашей библиотеке!",
+            reply_markup=get_main_menu_keyboard()
+        )
+        return
+    
+    # Показываем информацию о книге и предлагаем добавить
+    title = selected_book.get('title', 'Без названия')
+    author = selected_book.get('author', 'Неизвестен')
+    
+    parts = [f"📖 {title}\n", f"👤 Автор: {author}\n"]
+    
+    if selected_book.get('genre'):
+        parts.append(f"📂 Жанр: {selected_book['genre']}\n")
+    
+    if selected_book.get('first_publish_year'):
+        parts.append(f"📅 Год: {selected_book['first_publish_year']}\n")
+    
+    if selected_book.get('description_short'):
+        parts.append(f"📝 Описание: {selected_book['description_short']}\n")
+    
+    parts.append("\n⭐ Добавить в библиотеку с оценкой:")
+    
+    await _edit_message(
+        query,
+        ''.join(parts),
+        reply_markup=get_rating_keyboard(book_id)
+    )
+
+async def _cb_ol_book(query, context, user_id: int, page: str, book_index: str):
+    """Выбор книги из результатов поиска: ol_book_<page>_<index на странице>"""
     try:
-        query = update.callback_query
-        await query.answer()
+        book_index = int(page) * SEARCH_RESULTS_PER_PAGE + int(book_index)
         
-        data = query.data
-        user_id = update.effective_user.id
+        # Получаем результаты поиска из контекста
+        search_results = context.user_data.get('search_results', [])
         
-        # ПРИОРИТЕТ: Обработка выбора книги из результатов поиска
-        if data.startswith("ol_book_"):
-            try:
-                # Парсим данные из callback
-                parts = data.split("_")
-                page = int(parts[2]) if len(parts) > 2 else 0
-                book_index = int(parts[3]) if len(parts) > 3 else 0
-                
-                # Получаем результаты поиска из контекста
-                search_results = context.user_data.get('search_results', [])
-                
-                if book_index >= len(search_results):
-                    await query.edit_message_text("❌ Книга не найдена", reply_markup=get_main_menu_keyboard())
-                    return
-                
-                selected_book = search_results[book_index]
-                
-                # Добавляем книгу в глобальную базу
-                book_id = add_book_to_global(
-                    title=selected_book.get('title', ''),
-                    author=selected_book.get('author', ''),
-                    genre=selected_book.get('genre', ''),
-                    description=selected_book.get('description', ''),
-                    openlibrary_id=selected_book.get('external_id', ''),
-                    cover_url=selected_book.get('cover_url', ''),
-                    publication_year=selected_book.get('first_publish_year')
-                )
-                
-                # Проверяем, нет ли уже книги в библиотеке пользователя
-                if check_book_in_user_library(user_id, book_id):
-                    await query.edit_message_text(
-                        "📚 Эта книга уже есть в вашей библиотеке!",
-                        reply_markup=get_main_menu_keyboard()
-                    )
-                    return
-                
-                # Показываем информацию о книге и предлагаем добавить
-                title = selected_book.get('title', 'Без названия')
-                author = selected_book.get('author', 'Неизвестен')
-                
-                message = f"📖 {title}\n"
-                message += f"👤 Автор: {author}\n"
-                
-                if selected_book.get('genre'):
-                    message += f"📂 Жанр: {selected_book['genre']}\n"
-                
-                if selected_book.get('first_publish_year'):
-                    message += f"📅 Год: {selected_book['first_publish_year']}\n"
-                
-                if selected_book.get('description'):
-                    desc = selected_book['description']
-                    if len(desc) > 200:
-                        desc = desc[:197] + "..."
-                    message += f"📝 Описание: {desc}\n"
-                
-                message += "\n⭐ Добавить в библиотеку с оценкой:"
-                
-                await query.edit_message_text(
-                    message,
-                    reply_markup=get_rating_keyboard(book_id)
-                )
-                return
-            except Exception as e:
-                logger.error(f"Ошибка при выборе книги: {e}")
-                await query.edit_message_text("❌ Ошибка при добавлении книги", reply_markup=get_main_menu_keyboard())
-                return
-        elif data.startswith("search_page_"):
-        # Парсим номер страницы
-            try:
-                parts = data.split("_")
-                page = int(parts[2])
-            except (IndexError, ValueError):
-                page = 0
-
-         # Восстанавливаем из контекста все результаты и параметры поиска
-            selected_source = context.user_data.get('selected_source', 'openlibrary')
-            query_text      = context.user_data.get('search_query', '')
-            all_books       = context.user_data.get('search_results', [])
-
-         # Настройки пагинации
-            page_size = 5
-            total_pages = (len(all_books) + page_size - 1) // page_size
-            
-        # Корректируем номер страницы в пределах [0, total_pages-1]
-            page = max(0, min(page, total_pages - 1))
-
-         # Если страница пустая — сброс на границу
-            start = page * page_size
-            end   = start + page_size
-            page_books = all_books[start:end]
+        if book_index >= len(search_results):
+            await _edit_message(query, "❌ Книга не найдена", reply_markup=get_main_menu_keyboard())
+            return
+        
+        await _present_search_result(query, context, user_id, book_index)
+    except Exception as e:
+        logger.error(f"Ошибка при выборе книги: {e}")
+        await _edit_message(query, "❌ Ошибка при добавлении книги", reply_markup=get_main_menu_keyboard())
 
+async def _cb_search_page(query, context, user_id: int, page: str):
+    """Переход по страницам результатов поиска: search_page_<page>"""
+    page = int(page)
+    
+    # Восстанавливаем из контекста все результаты поиска
+    all_books = context.user_data.get('search_results', [])
+    
+    # Настройки пагинации
+    total_pages = (len(all_books) + SEARCH_RESULTS_PER_PAGE - 1) // SEARCH_RESULTS_PER_PAGE
+    
+    # Корректируем номер страницы в пределах [0, total_pages-1]
+    page = max(0, min(page, total_pages - 1))
+    
+    start = page * SEARCH_RESULTS_PER_PAGE
+    page_books = all_books[start:start + SEARCH_RESULTS_PER_PAGE]
+    
     # Перерисовываем список и навигацию
-            await query.edit_message_text(
-                 f"🔍 Результаты поиска «{context.user_data.get('search_query')}»\nстраница {page+1}/{total_pages}:",
-                 reply_markup=get_search_results_keyboard(
-                    books=page_books,
-                    page=page,
-                    source=context.user_data.get("selected_source","openlibrary")
-                )
-            )
-            return
+    await _edit_message(
+        query,
+        f"🔍 Результаты поиска «{context.user_data.get('search_query')}»\nстраница {page+1}/{total_pages}:",
+        reply_markup=get_search_results_keyboard(
+            books=page_books,
+            page=page,
+            total_pages=total_pages,
+            source=context.user_data.get("selected_source", "openlibrary")
+        )
+    )
 
+async def _cb_db_book(query, context, user_id: int, external_id: str):
+    """Выбор книги из результатов поиска по внешнему ID: db_book_<external_id>"""
+    book_index = context.user_data.get('search_results_by_eid', {}).get(external_id)
+    if book_index is None:
+        await _edit_message(query, "❌ Книга не найдена", reply_markup=get_main_menu_keyboard())
+        return
 
-        elif data.startswith("db_book_"):
+    await _present_search_result(query, context, user_id, book_index)
 
-            # Раскладываем callback_data: "db_book_<external_id>"
-            external_id = data.split("_", 1)[1]
-            search_results = context.user_data.get('search_results', [])
-            selected_book = next((b for b in search_results if b.get('external_id') == external_id), None)
-            if not selected_book:
-                await query.edit_message_text("❌ Книга не найдена", reply_markup=get_main_menu_keyboard())
-                return
+async def _cb_main_menu(query, context, user_id: int):
+    """Главное меню"""
+    await _edit_message(
+        query,
+        MESSAGES['choose_action'],
+        reply_markup=get_main_menu_keyboard()
+    )
 
-            book_id = add_book_to_global(
-                title=selected_book.get('title', ''),
-                author=selected_book.get('author', ''),
-                genre=selected_book.get('genre', ''),
-                description=selected_book.get('description', ''),
-                openlibrary_id=selected_book.get('external_id', ''),
-                cover_url=selected_book.get('cover_url', ''),
-                publication_year=selected_book.get('first_publish_year')
-            )
+async def _cb_add_book(query, context, user_id: int):
+    """Выбор способа добавления книги"""
+    await _edit_message(
+        query,
+        "📖 Выберите способ добавления книги:",
+        reply_markup=get_add_book_keyboard()
+    )
 
-            if check_book_in_user_library(user_id, book_id):
-                await query.edit_message_text(
-                    "📚 Эта книга уже есть в вашей библиотеке!",
-                    reply_markup=get_main_menu_keyboard()
-                )
-                return
+async def _cb_add_manual(query, context, user_id: int):
+    """Начало ручного добавления книги"""
+    await clear_user_state(user_id)
+    WIZARD_STATE[user_id] = {'step': 'title', 'data': {}}
+    await _edit_message(
+        query,
+        "📖 Введите название книги:",
+        reply_markup=get_cancel_keyboard()
+    )
 
-            title = selected_book.get('title', 'Без названия')
-            author = selected_book.get('author', 'Неизвестен')
-            message = f"📖 {title}\n👤 Автор: {author}\n"
-            if selected_book.get('genre'):
-                message += f"📂 Жанр: {selected_book['genre']}\n"
-            if selected_book.get('first_publish_year'):
-                message += f"📅 Год: {selected_book['first_publish_year']}\n"
-            if selected_book.get('description'):
-                desc = selected_book['description']
-                if len(desc) > 200:
-                    desc = desc[:197] + "..."
-                message += f"📝 Описание: {desc}\n"
-            message += "\n⭐ Добавить в библиотеку с оценкой:"
-
-            await query.edit_message_text(
-                message,
-                reply_markup=get_rating_keyboard(book_id)
-            )
-            return
-        
-        # Главное меню
-        if data == "main_menu":
-            await query.edit_message_text(
-                MESSAGES['choose_action'],
-                reply_markup=get_main_menu_keyboard()
-            )
-        
-        # Добавление книги
-        elif data == "add_book":
-            await query.edit_message_text(
-                "📖 Выберите способ добавления книги:",
-                reply_markup=get_add_book_keyboard()
-            )
-        
-        elif data == "add_manual":
-            clear_user_state(user_id)
-            set_user_state(user_id, 'adding_manual_book', json.dumps({'step': 'title', 'data': {}}))
-            await query.edit_message_text(
-                "📖 Введите название книги:",
-                reply_markup=get_cancel_keyboard()
-            )
-        
-        elif data == "search_multiple_sources":
-            await query.edit_message_text(
-                "🌐 Выберите источник для поиска книг:",
-                reply_markup=get_book_sources_keyboard()
-            )
-        
-        # Обработка выбора источника
-        elif data.startswith("source_"):
-            source_type = data[7:]  # Убираем префикс "source_"
-            context.user_data['selected_source'] = source_type
-            set_user_state(user_id, 'waiting_search_query')
-            
-            source_names = {
-                'openlibrary': '📚 Open Library',
-                'googlebooks': '📖 Google Books',
-                'loc': '🏛️ Library of Congress',
-                'isbndb': '📘 ISBNDB',
-                'all': '🔍 Все источники'
-            }
-            
-            source_name = source_names.get(source_type, 'выбранном источнике')
-            message = f"🔍 Поиск в {source_name}\n\n" + MESSAGES['enter_search_query']
-            
-            await query.edit_message_text(
-                message,
-                reply_markup=get_cancel_keyboard()
-            )
-        
-        # Библиотека
-        elif data == "my_library":
-            books = get_user_books(user_id)
-            if not books:
-                await query.edit_message_text(
-                    MESSAGES['empty_library'],
-                    reply_markup=get_main_menu_keyboard()
-                )
-            else:
-                await query.edit_message_text(
-                    f"📚 Ваша библиотека ({len(books)} книг):",
-                    reply_markup=get_library_menu_keyboard()
-                )
-        
-        elif data == "library_all":
-            await show_user_books(query, user_id)
-        
-        elif data == "library_sort":
-            await query.edit_message_text(
-                "🔤 Выберите критерий сортировки:",
-                reply_markup=get_sort_keyboard()
-            )
-        
-        elif data.startswith("sort_"):
-            sort_by = data[5:]  # Убираем префикс "sort_"
-            await show_user_books(query, user_id, sort_by=sort_by)
-        
-        # Поиск
-        elif data == "search_books":
-            set_user_state(user_id, 'waiting_search_query')
-            await query.edit_message_text(
-                MESSAGES['enter_search_query'],
-                reply_markup=get_cancel_keyboard()
-            )
-        
-        # Рекомендации
-        elif data == "recommendations":
-            recommendations = recommendation_system.get_recommendations(user_id)
-            
-            if not recommendations:
-                await query.edit_message_text(
-                    MESSAGES['no_recommendations'],
-                    reply_markup=get_main_menu_keyboard()
-                )
-                return
-            
-            # Показываем рекомендации
-            message = "✨ Рекомендации для вас:\n\n"
-            
-            for i, book in enumerate(recommendations[:5], 1):
-                message += f"{i}. 📖 *{book['title']}*\n"
-                message += f"👤 {book['author']}\n"
-                if book.get('genre'):
-                    message += f"📂 {book['genre']}\n"
-                message += "\n"
-            
-            await query.edit_message_text(
-                message,
-                parse_mode='Markdown',
-                reply_markup=get_recommendations_keyboard()
-            )
-        
-        elif data == "refresh_recommendations":
-            # Пересчитываем рекомендации
-            recommendations = recommendation_system.get_recommendations(user_id)
-            
-            message = "✨ Обновленные рекомендации:\n\n"
-            
-            for i, book in enumerate(recommendations[:5], 1):
-                message += f"{i}. 📖 *{book['title']}*\n"
-                message += f"👤 {book['author']}\n"
-                if book.get('genre'):
-                    message += f"📂 {book['genre']}\n"
-                message += "\n"
-            
-            await query.edit_message_text(
-                message,
-                parse_mode='Markdown',
-                reply_markup=get_recommendations_keyboard()
-            )
-        
-        # Действия с книгами
-        elif data.startswith("add_to_library_"):
-            book_id = int(data.split("_")[-1])
-            
-            # Проверяем, нет ли уже книги в библиотеке
-            if check_book_in_user_library(user_id, book_id):
-                await query.edit_message_text("📚 Эта книга уже есть в вашей библиотеке!")
-                return
-            
-            set_user_state(user_id, 'waiting_rating', str(book_id))
-            await query.edit_message_text(
-                "⭐ Введите вашу оценку книги (от 1 до 10):",
-                reply_markup=get_cancel_keyboard()
-            )
-        
-        elif data.startswith("rate_"):
-            # разбираем данные
-            _, str_book_id, str_rating = data.split("_")
-            book_id = int(str_book_id)
-            rating = int(str_rating)
-
-            # если ещё не в библиотеке — вставляем, иначе обновляем
-            if not check_book_in_user_library(user_id, book_id):
-                add_book_to_user_library(user_id, book_id, rating)
-                text = MESSAGES['book_added']      # «Книга добавлена и оценка 
-            else:   
-                update_user_book_rating(user_id, book_id, rating)
-                text = MESSAGES['book_updated']    # «Оценка обновлена»
-            await query.edit_message_text(
-                text,
-                reply_markup=get_main_menu_keyboard()
-            )
-        
-        elif data.startswith("remove_book_"):
-            book_id = int(data.split("_")[-1])
-            await query.edit_message_text(
-                "🗑️ Вы уверены, что хотите удалить эту книгу из библиотеки?",
-                reply_markup=get_confirmation_keyboard("remove", book_id)
-            )
-        
+async def _cb_search_multiple_sources(query, context, user_id: int):
+    """Выбор источника для поиска"""
+    await _edit_message(
+        query,
+        "🌐 Выберите источник для поиска книг:",
+        reply_markup=get_book_sources_keyboard()
+    )
 
+async def _cb_source(query, context, user_id: int, source_type: str):
+    """Выбор источника: source_<source_id>"""
+    context.user_data['selected_source'] = source_type
+    await _set_state(user_id, 'waiting_search_query')
+    
+    source = SOURCES.get(source_type)
+    source_name = f"{source.emoji} {source.name}" if source else 'выбранном источнике'
+    message = f"🔍 Поиск в {source_name}\n\n" + MESSAGES['enter_search_query']
+    
+    await _edit_message(
+        query,
+        message,
+        reply_markup=get_cancel_keyboard()
+    )
+
+async def _cb_my_library(query, context, user_id: int):
+    """Меню библиотеки"""
+    books_count = await get_user_books_count(user_id)
+    if not books_count:
+        await _edit_message(
+            query,
+            MESSAGES['empty_library'],
+            reply_markup=get_main_menu_keyboard()
+        )
+    else:
+        await _edit_message(
+            query,
+            f"📚 Ваша библиотека ({books_count} книг):",
+            reply_markup=get_library_menu_keyboard()
+        )
+
+async def _cb_library_all(query, context, user_id: int):
+    """Список всех книг библиотеки"""
+    await show_user_books(query, user_id)
+
+async def _cb_library_sort(query, context, user_id: int):
+    """Выбор критерия сортировки"""
+    await _edit_message(
+        query,
+        "🔤 Выберите критерий сортировки:",
+        reply_markup=get_sort_keyboard()
+    )
+
+async def _cb_sort(query, context, user_id: int, sort_by: str):
+    """Список книг с сортировкой: sort_<field>"""
+    await show_user_books(query, user_id, sort_by=sort_by)
+
+async def _cb_library_page(query, context, user_id: int, page: str, sort_by: str):
+    """Страница библиотеки: library_page_<page>_<sort_by>"""
+    await show_user_books(query, user_id, sort_by=sort_by, page=int(page))
+
+async def _cb_noop(query, context, user_id: int):
+    """Кнопка-индикатор номера страницы, действий не требует"""
+
+async def _cb_search_books(query, context, user_id: int):
+    """Запрос поисковой строки"""
+    await _set_state(user_id, 'waiting_search_query')
+    await _edit_message(
+        query,
+        MESSAGES['enter_search_query'],
+        reply_markup=get_cancel_keyboard()
+    )
+
+async def _cb_recommendations(query, context, user_id: int):
+    """Показ рекомендаций"""
+    recommendations = await _get_recommendations(user_id)
+    
+    if not recommendations:
+        await _edit_message(
+            query,
+            MESSAGES['no_recommendations'],
+            reply_markup=get_main_menu_keyboard()
+        )
+        return
+    
+    # Показываем рекомендации
+    parts = ["✨ Рекомендации для вас:\n\n"]
+    
+    for i, book in enumerate(recommendations[:5], 1):
+        parts.append(f"{i}. 📖 *{book['title_md']}*\n")
+        parts.append(f"👤 {book['author_md']}\n")
+        if book.get('genre'):
+            parts.append(f"📂 {book['genre_md']}\n")
+        parts.append("\n")
+    
+    await _edit_message(
+        query,
+        ''.join(parts),
+        parse_mode='Markdown',
+        reply_markup=get_recommendations_keyboard()
+    )
+
+async def _cb_refresh_recommendations(query, context, user_id: int):
+    """Пересчет рекомендаций"""
+    recommendations = await _get_recommendations(user_id, refresh=True)
+    
+    parts = ["✨ Обновленные рекомендации:\n\n"]
+    
+    for i, book in enumerate(recommendations[:5], 1):
+        parts.append(f"{i}. 📖 *{book['title_md']}*\n")
+        parts.append(f"👤 {book['author_md']}\n")
+        if book.get('genre'):
+            parts.append(f"📂 {book['genre_md']}\n")
+        parts.append("\n")
+    
+    await _edit_message(
+        query,
+        ''.join(parts),
+        parse_mode='Markdown',
+        reply_markup=get_recommendations_keyboard()
+    )
+
+async def _cb_add_to_library(query, context, user_id: int, book_id: str):
+    """Запрос оценки для добавления книги: add_to_library_<book_id>"""
+    book_id = int(book_id)
+    
+    # Проверяем, нет ли уже книги в библиотеке
+    if await check_book_in_user_library(user_id, book_id):
+        await _edit_message(query, "📚 Эта книга уже есть в вашей библиотеке!")
+        return
+    
+    await _set_state(user_id, 'waiting_rating', f"{book_id}")
+    await _edit_message(
+        query,
+        "⭐ Введите вашу оценку книги (от 1 до 10):",
+        reply_markup=get_cancel_keyboard()
+    )
+
+async def _cb_rate(query, context, user_id: int, book_id: str, rating: str):
+    """Оценка книги: rate_<book_id>_<rating>"""
+    book_id = int(book_id)
+    rating = int(rating)
+
+    # если ещё не в библиотеке — вставляем, иначе обновляем (одним обращением к базе)
+    if await rate_user_book(user_id, book_id, rating):
+        text = MESSAGES['book_added']      # «Книга добавлена в библиотеку»
+    else:
+        text = MESSAGES['book_updated']    # «Оценка обновлена»
+    _REC_CACHE.pop(user_id, None)
+    await _edit_message(
+        query,
+        text,
+        reply_markup=get_main_menu_keyboard()
+    )
+
+async def _cb_remove_book(query, context, user_id: int, book_id: str):
+    """Подтверждение удаления книги: remove_book_<book_id>"""
+    await _edit_message(
+        query,
+        "🗑️ Вы уверены, что хотите удалить эту книгу из библиотеки?",
+        reply_markup=get_confirmation_keyboard("remove", int(book_id))
+    )
+
+async def _cb_confirm_remove(query, context, user_id: int, book_id: str):
+    """Удаление книги: confirm_remove_<book_id>"""
+    await remove_book_from_user_library(user_id, int(book_id))
+    _REC_CACHE.pop(user_id, None)
+    
+    await _edit_message(
+        query,
+        MESSAGES['book_deleted'],
+        reply_markup=get_main_menu_keyboard()
+    )
+
+async def _cb_edit_rating(query, context, user_id: int, book_id: str):
+    """Выбор новой оценки: edit_rating_<book_id>"""
+    await _edit_message(
+        query,
+        "⭐ Выберите новую оценку:",
+        reply_markup=get_rating_keyboard(int(book_id))
+    )
+
+async def _cb_cancel(query, context, user_id: int):
+    """Отмена текущего действия"""
+    await _clear_state(user_id)
+    await _edit_message(
+        query,
+        MESSAGES['cancel'],
+        reply_markup=get_main_menu_keyboard()
+    )
+
+async def _cb_help(query, context, user_id: int):
+    """Справка"""
+    await _edit_message(
+        query,
+        MESSAGES['help'],
+        reply_markup=get_main_menu_keyboard()
+    )
+
+# callback_data без параметров
+CALLBACK_ROUTES = {
+    'main_menu': _cb_main_menu,
+    'add_book': _cb_add_book,
+    'add_manual': _cb_add_manual,
+    'search_multiple_sources': _cb_search_multiple_sources,
+    'my_library': _cb_my_library,
+    'library_all': _cb_library_all,
+    'library_sort': _cb_library_sort,
+    'search_books': _cb_search_books,
+    'recommendations': _cb_recommendations,
+    'refresh_recommendations': _cb_refresh_recommendations,
+    'cancel': _cb_cancel,
+    'help': _cb_help,
+    'noop': _cb_noop,
+}
+
+# callback_data с параметрами: группы регулярного выражения передаются в обработчик
+PREFIX_ROUTES = [
+    (r'ol_book_(\d+)_(\d+)', _cb_ol_book),
+    (r'search_page_(\d+)', _cb_search_page),
+    (r'db_book_(.+)', _cb_db_book),
+    (r'source_(\w+)', _cb_source),
+    (r'sort_(\w+)', _cb_sort),
+    (r'library_page_(\d+)_(\w+)', _cb_library_page),
+    (r'add_to_library_(\d+)', _cb_add_to_library),
+    (r'rate_(\d+)_(\d+)', _cb_rate),
+    (r'remove_book_(\d+)', _cb_remove_book),
+    (r'confirm_remove_(\d+)', _cb_confirm_remove),
+    (r'edit_rating_(\d+)', _cb_edit_rating),
+]
+
+def _compile_prefix_routes(routes):
+    """Объединение шаблонов callback_data в одно регулярное выражение с именованными группами"""
+    alternatives = []
+    handlers = {}
+    group = 1
+    for i, (pattern, handler) in enumerate(routes):
+        name = f"r{i}"
+        params = re.compile(pattern).groups
+        alternatives.append(f"(?P<{name}>{pattern})")
+        # Параметры маршрута занимают группы сразу после его именованной группы
+        handlers[name] = (handler, group, group + params)
+        group += params + 1
+    return re.compile('|'.join(alternatives)), handlers
+
+# Одно сопоставление на callback вместо перебора шаблонов по очереди
+PREFIX_PATTERN, PREFIX_HANDLERS = _compile_prefix_routes(PREFIX_ROUTES)
+
+async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик callback запросов от inline клавиатур"""
+    query = update.callback_query
+    logger.info(f"Callback получен: {query.data} от {query.from_user.id}")
+    # Ответ отправляется до ожидания блокировки пользователя: иначе при повторном нажатии
+    # индикатор загрузки на кнопке крутится, пока не закончится предыдущий обработчик
+    try:
+        await query.answer()
+    except BadRequest as e:
+        logger.error(f"BadRequest при ответе на callback: {e}")
+    
+    await _dispatch_callback_query(update, context)
+
+@per_user_lock
+async def _dispatch_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выполнение обработчика callback запроса под блокировкой пользователя"""
+    try:
+        query = update.callback_query
+        data = query.data
+        user_id = update.effective_user.id
         
-        elif data.startswith("confirm_remove_"):
-            book_id = int(data.split("_")[-1])
-            remove_book_from_user_library(user_id, book_id)
-            
-            await query.edit_message_text(
-                MESSAGES['book_deleted'],
-                reply_markup=get_main_menu_keyboard()
-            )
-        
-        elif data.startswith("edit_rating_"):
-            book_id = int(data.split("_")[-1])
-            await query.edit_message_text(
-                "⭐ Выберите новую оценку:",
-                reply_markup=get_rating_keyboard(book_id)
-            )
-        
-        # Отмена
-        elif data == "cancel":
-            clear_user_state(user_id)
-            await query.edit_message_text(
-                MESSAGES['cancel'],
-                reply_markup=get_main_menu_keyboard()
-            )
-        
-        # Помощь
-        elif data == "help":
-            await query.edit_message_text(
-                MESSAGES['help'],
-                reply_markup=get_main_menu_keyboard()
-            )
+        handler = CALLBACK_ROUTES.get(data)
+        if handler:
+            await handler(query, context, user_id)
+            return
         
-        # Обработка выбора книги из результатов поиска  
-        elif data.startswith("ol_book_"):
-            try:
-                # Парсим данные из callback
-                parts = data.split("_")
-                page = int(parts[2]) if len(parts) > 2 else 0
-                book_index = int(parts[3]) if len(parts) > 3 else 0
-                
-                # Получаем результаты поиска из контекста
-                search_results = context.user_data.get('search_results', [])
-                
-                if book_index >= len(search_results):
-                    await query.edit_message_text("❌ Книга не найдена", reply_markup=get_main_menu_keyboard())
-                    return
-                
-                selected_book = search_results[book_index]
-                
-                # Добавляем книгу в глобальную базу
-                book_id = add_book_to_global(
-                    title=selected_book.get('title', ''),
-                    author=selected_book.get('author', ''),
-                    genre=selected_book.get('genre', ''),
-                    description=selected_book.get('description', ''),
-                    openlibrary_id=selected_book.get('external_id', ''),
-                    cover_url=selected_book.get('cover_url', ''),
-                    publication_year=selected_book.get('first_publish_year')
-                )
-                
-                # Проверяем, нет ли уже книги в библиотеке пользователя
-                if check_book_in_user_library(user_id, book_id):
-                    await query.edit_message_text(
-                        "📚 Эта книга уже есть в вашей библиотеке!",
-                        reply_markup=get_main_menu_keyboard()
-                    )
-                    return
-                
-                # Показываем информацию о книге и предлагаем добавить
-                title = selected_book.get('title', 'Без названия')
-                author = selected_book.get('author', 'Неизвестен')
-                
-                message = f"📖 {title}\n"
-                message += f"👤 Автор: {author}\n"
-                
-                if selected_book.get('genre'):
-                    message += f"📂 Жанр: {selected_book['genre']}\n"
-                
-                if selected_book.get('first_publish_year'):
-                    message += f"📅 Год: {selected_book['first_publish_year']}\n"
-                
-                if selected_book.get('description'):
-                    desc = selected_book['description']
-                    if len(desc) > 200:
-                        desc = desc[:197] + "..."
-                    message += f"📝 Описание: {desc}\n"
-                
-                message += "\n⭐ Добавить в библиотеку с оценкой:"
-                
-                await query.edit_message_text(
-                    message,
-                    reply_markup=get_rating_keyboard(book_id)
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при выборе книги: {e}")
-                await query.edit_message_text("❌ Ошибка при добавлении книги", reply_markup=get_main_menu_keyboard())
+        match = PREFIX_PATTERN.fullmatch(data)
+        if match:
+            handler, first, last = PREFIX_HANDLERS[match.lastgroup]
+            await handler(query, context, user_id, *match.groups()[first:last])
+            return
         
-        else:
-            logger.warning(f"Неизвестный callback_data: {data}")
+        logger.warning(f"Неизвестный callback_data: {data}")
         
     except BadRequest as e:
         logger.error(f"BadRequest в handle_callback_query: {e}")
@@ -818,45 +899,37 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
 async def show_user_books(query, user_id: int, sort_by: str = 'date_added', page: int = 0):
     """Показ книг пользователя с пагинацией"""
     try:
-        books = get_user_books(user_id, sort_by=sort_by)
+        total_books = await get_user_books_count(user_id)
         
-        if not books:
-            await query.edit_message_text(
+        if not total_books:
+            await _edit_message(
+                query,
                 MESSAGES['empty_library'],
                 reply_markup=get_main_menu_keyboard()
             )
             return
         
-        # Пагинация
+        # Пагинация: из базы читаем только нужную страницу
+        total_pages = (total_books + BOOKS_PER_PAGE - 1) // BOOKS_PER_PAGE
+        page = max(0, min(page, total_pages - 1))
         start_idx = page * BOOKS_PER_PAGE
-        end_idx = start_idx + BOOKS_PER_PAGE
-        page_books = books[start_idx:end_idx]
-        
-        total_pages = (len(books) + BOOKS_PER_PAGE - 1) // BOOKS_PER_PAGE
+        page_books = await get_user_books_page(user_id, sort_by=sort_by, limit=BOOKS_PER_PAGE, offset=start_idx)
         
         # Формируем сообщение
-        sort_names = {
-            'date_added': 'дате добавления',
-            'title': 'названию',
-            'author': 'автору',
-            'genre': 'жанру',
-            'rating': 'оценке'
-        }
-        
-        message = f"📚 Ваша библиотека (сортировка по {sort_names.get(sort_by, sort_by)}):\n\n"
+        parts = [f"📚 Ваша библиотека (сортировка по {SORT_NAMES.get(sort_by, sort_by)}):\n\n"]
         
         for i, book in enumerate(page_books, start_idx + 1):
-            message += f"{i}. 📖 *{book['title']}*\n"
-            message += f"👤 {book['author']}\n"
+            parts.append(f"{i}. 📖 *{book['title_md']}*\n")
+            parts.append(f"👤 {book['author_md']}\n")
             
             if book.get('genre'):
-                message += f"📂 {book['genre']}\n"
+                parts.append(f"📂 {book['genre_md']}\n")
             
             if book.get('user_rating'):
                 stars = "⭐" * book['user_rating']
-                message += f"⭐ {stars} ({book['user_rating']}/10)\n"
+                parts.append(f"⭐ {stars} ({book['user_rating']}/10)\n")
             
-            message += "\n"
+            parts.append("\n")
         
         # Создаем клавиатуру с пагинацией
         keyboard = []
@@ -865,27 +938,25 @@ async def show_user_books(query, user_id: int, sort_by: str = 'date_added', page
         if total_pages > 1:
             nav_buttons = []
             if page > 0:
-                nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"library_page_{page-1}_{sort_by}"))
+                nav_buttons.append(get_button("⬅️", f"library_page_{page-1}_{sort_by}"))
             
-            nav_buttons.append(InlineKeyboardButton(f"{page + 1}/{total_pages}", callback_data="noop"))
+            nav_buttons.append(get_button(f"{page + 1}/{total_pages}", "noop"))
             
             if page < total_pages - 1:
-                nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"library_page_{page+1}_{sort_by}"))
+                nav_buttons.append(get_button("➡️", f"library_page_{page+1}_{sort_by}"))
             
             keyboard.append(nav_buttons)
         
         # Кнопки управления
-        keyboard.extend([
-            [InlineKeyboardButton("🔤 Сортировка", callback_data="library_sort")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="my_library")]
-        ])
+        keyboard.extend(LIBRARY_CONTROL_ROWS)
         
-        await query.edit_message_text(
-            message,
+        await _edit_message(
+            query,
+            ''.join(parts),
             parse_mode='Markdown',
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         
     except Exception as e:
         logger.error(f"Ошибка в show_user_books: {e}")
-        await query.edit_message_text(MESSAGES['error'])
+        await _edit_message(query, MESSAGES['error'])
@@ -4,62 +4,98 @@
 Модуль клавиатур для Telegram бота
 """
 
+import functools
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
 from typing import List, Dict
 
+# Кнопки возврата, общие для многих клавиатур
+_BACK_TO_MAIN = InlineKeyboardButton("🔙 Назад", callback_data="main_menu")
+_BACK_TO_ADD = InlineKeyboardButton("🔙 Назад", callback_data="add_book")
+_BACK_TO_LIBRARY = InlineKeyboardButton("🔙 Назад", callback_data="my_library")
+_MAIN_MENU_BUTTON = InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")
+
+# Клавиатуры без параметров одинаковы для всех пользователей, создаем их один раз при импорте
+
+# Главное меню бота
+_MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📖 Добавить книгу", callback_data="add_book")],
+    [InlineKeyboardButton("📚 Моя библиотека", callback_data="my_library")],
+    [InlineKeyboardButton("🔍 Поиск книг", callback_data="search_books")],
+    [InlineKeyboardButton("✨ Рекомендации", callback_data="recommendations")],
+    [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")]
+])
+
+# Клавиатура для добавления книги
+_ADD_BOOK = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🌐 Найти в общей библиотеке", callback_data="search_multiple_sources")],
+    [InlineKeyboardButton("📝 Добавить вручную", callback_data="add_manual")],
+    [_BACK_TO_MAIN]
+])
+
+# Клавиатура для выбора источника книг
+_BOOK_SOURCES = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 Open Library", callback_data="source_openlibrary")],
+    [InlineKeyboardButton("📖 Google Books", callback_data="source_googlebooks")],
+    [InlineKeyboardButton("🏛️ Library of Congress", callback_data="source_loc")],
+    [InlineKeyboardButton("📘 ISBNDB", callback_data="source_isbndb")],
+    [InlineKeyboardButton("🔍 Все источники", callback_data="source_all")],
+    [_BACK_TO_ADD]
+])
+
+# Клавиатура для библиотеки
+_LIBRARY_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Все книги", callback_data="library_all")],
+    [InlineKeyboardButton("🔤 Сортировка", callback_data="library_sort")],
+    [InlineKeyboardButton("🔍 Поиск", callback_data="library_search")],
+    [_BACK_TO_MAIN]
+])
+
+# Клавиатура для сортировки
+_SORT = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 По дате добавления", callback_data="sort_date")],
+    [InlineKeyboardButton("🔤 По названию", callback_data="sort_title")],
+    [InlineKeyboardButton("👤 По автору", callback_data="sort_author")],
+    [InlineKeyboardButton("📂 По жанру", callback_data="sort_genre")],
+    [InlineKeyboardButton("⭐ По оценке", callback_data="sort_rating")],
+    [_BACK_TO_LIBRARY]
+])
+
+# Клавиатура с кнопкой отмены
+_CANCEL = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отменить", callback_data="cancel")]])
+
+# Клавиатура для рекомендаций
+_RECOMMENDATIONS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Обновить рекомендации", callback_data="refresh_recommendations")],
+    [_MAIN_MENU_BUTTON]
+])
+
+@functools.lru_cache(maxsize=4096)
+def get_button(text: str, callback_data: str) -> InlineKeyboardButton:
+    """Кнопка с callback_data; одинаковые кнопки разных клавиатур — один и тот же объект"""
+    return InlineKeyboardButton(text, callback_data=callback_data)
+
+# Подписи кнопок оценок 1-10
+_RATING_LABELS = tuple(f"{i}" for i in range(1, 11))
+
 def get_main_menu_keyboard():
     """Главное меню бота"""
-    keyboard = [
-        [InlineKeyboardButton("📖 Добавить книгу", callback_data="add_book")],
-        [InlineKeyboardButton("📚 Моя библиотека", callback_data="my_library")],
-        [InlineKeyboardButton("🔍 Поиск книг", callback_data="search_books")],
-        [InlineKeyboardButton("✨ Рекомендации", callback_data="recommendations")],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _MAIN_MENU
 
 def get_add_book_keyboard():
     """Клавиатура для добавления книги"""
-    keyboard = [
-        [InlineKeyboardButton("🌐 Найти в общей библиотеке", callback_data="search_multiple_sources")],
-        [InlineKeyboardButton("📝 Добавить вручную", callback_data="add_manual")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _ADD_BOOK
 
 def get_book_sources_keyboard():
     """Клавиатура для выбора источника книг"""
-    keyboard = [
-        [InlineKeyboardButton("📚 Open Library", callback_data="source_openlibrary")],
-        [InlineKeyboardButton("📖 Google Books", callback_data="source_googlebooks")],
-        [InlineKeyboardButton("🏛️ Library of Congress", callback_data="source_loc")],
-        [InlineKeyboardButton("📘 ISBNDB", callback_data="source_isbndb")],
-        [InlineKeyboardButton("🔍 Все источники", callback_data="source_all")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="add_book")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _BOOK_SOURCES
 
 def get_library_menu_keyboard():
     """Клавиатура для библиотеки"""
-    keyboard = [
-        [InlineKeyboardButton("📋 Все книги", callback_data="library_all")],
-        [InlineKeyboardButton("🔤 Сортировка", callback_data="library_sort")],
-        [InlineKeyboardButton("🔍 Поиск", callback_data="library_search")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="main_menu")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _LIBRARY_MENU
 
 def get_sort_keyboard():
     """Клавиатура для сортировки"""
-    keyboard = [
-        [InlineKeyboardButton("📅 По дате добавления", callback_data="sort_date")],
-        [InlineKeyboardButton("🔤 По названию", callback_data="sort_title")],
-        [InlineKeyboardButton("👤 По автору", callback_data="sort_author")],
-        [InlineKeyboardButton("📂 По жанру", callback_data="sort_genre")],
-        [InlineKeyboardButton("⭐ По оценке", callback_data="sort_rating")],
-        [InlineKeyboardButton("🔙 Назад", callback_data="my_library")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _SORT
 
 def get_book_actions_keyboard(book_id: int, in_library: bool = False):
     """Клавиатура действий с книгой"""
@@ -74,12 +110,9 @@ def get_book_actions_keyboard(book_id: int, in_library: bool = False):
             [InlineKeyboardButton("🗑️ Удалить из библиотеки", callback_data=f"remove_book_{book_id}")]
         ])
     
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="my_library")])
+    keyboard.append([_BACK_TO_LIBRARY])
     return InlineKeyboardMarkup(keyboard)
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from typing import List, Dict
-
 def get_search_results_keyboard(
     books: List[Dict],
     page: int,
@@ -87,7 +120,7 @@ def get_search_results_keyboard(
     source: str = "openlibrary"
 ) -> InlineKeyboardMarkup:
     """
-    books        — список книг на текущей странице,
+    books        — список книг на текущей странице (с полями из add_display_fields),
     page         — индекс текущей страницы (0-based),
     total_pages  — общее число страниц,
     source       — 'openlibrary' или 'database'.
@@ -99,23 +132,21 @@ def get_search_results_keyboard(
             cb = f"ol_book_{page}_{idx}"
         else:
             cb = f"db_book_{book.get('external_id','')}"
-        title = book.get("title", "Без названия")[:30]
-        author = book.get("author", "Неизвестный")[:20]
         keyboard.append([
-            InlineKeyboardButton(f"📖 {title} — {author}", callback_data=cb)
+            get_button(f"📖 {book['title_short']} — {book['author_short']}", cb)
         ])
 
     # 2) Навигационная строка
     nav = []
     if page > 0:
-        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"search_page_{page-1}"))
-    nav.append(InlineKeyboardButton(f"{page+1}/{total_pages}", callback_data="noop"))
+        nav.append(get_button("⬅️ Назад", f"search_page_{page-1}"))
+    nav.append(get_button(f"{page+1}/{total_pages}", "noop"))
     if page < total_pages - 1:
-        nav.append(InlineKeyboardButton("➡️ Далее", callback_data=f"search_page_{page+1}"))
+        nav.append(get_button("➡️ Далее", f"search_page_{page+1}"))
     keyboard.append(nav)
 
     # 3) В главное меню
-    keyboard.append([InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")])
+    keyboard.append([_MAIN_MENU_BUTTON])
 
     return InlineKeyboardMarkup(keyboard)
 
@@ -134,10 +165,11 @@ def get_pagination_keyboard(page: int, total_pages: int, action_prefix: str):
         nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"{action_prefix}_{page+1}"))
     
     keyboard.append(nav_buttons)
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="my_library")])
+    keyboard.append([_BACK_TO_LIBRARY])
     
     return InlineKeyboardMarkup(keyboard)
 
+@functools.lru_cache(maxsize=4096)
 def get_confirmation_keyboard(action: str, item_id: int):
     """Клавиатура подтверждения действия"""
     keyboard = [
@@ -148,16 +180,17 @@ def get_confirmation_keyboard(action: str, item_id: int):
     ]
     return InlineKeyboardMarkup(keyboard)
 
+@functools.lru_cache(maxsize=4096)
 def get_rating_keyboard(book_id: int):
     """Клавиатура для выбора оценки"""
     keyboard = []
     
     # Первый ряд: 1-5
-    row1 = [InlineKeyboardButton(str(i), callback_data=f"rate_{book_id}_{i}") for i in range(1, 6)]
+    row1 = [InlineKeyboardButton(label, callback_data=f"rate_{book_id}_{label}") for label in _RATING_LABELS[:5]]
     keyboard.append(row1)
     
     # Второй ряд: 6-10
-    row2 = [InlineKeyboardButton(str(i), callback_data=f"rate_{book_id}_{i}") for i in range(6, 11)]
+    row2 = [InlineKeyboardButton(label, callback_data=f"rate_{book_id}_{label}") for label in _RATING_LABELS[5:]]
     keyboard.append(row2)
     
     keyboard.append([InlineKeyboardButton("🔙 Отмена", callback_data="my_library")])
@@ -166,16 +199,11 @@ def get_rating_keyboard(book_id: int):
 
 def get_cancel_keyboard():
     """Клавиатура с кнопкой отмены"""
-    keyboard = [[InlineKeyboardButton("❌ Отменить", callback_data="cancel")]]
-    return InlineKeyboardMarkup(keyboard)
+    return _CANCEL
 
 def get_recommendations_keyboard():
     """Клавиатура для рекомендаций"""
-    keyboard = [
-        [InlineKeyboardButton("🔄 Обновить рекомендации", callback_data="refresh_recommendations")],
-        [InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return _RECOMMENDATIONS
 
 def get_book_detail_keyboard(book_id: int, in_library: bool = False, source: str = "db"):
     """Детальная клавиатура для отдельной книги"""
@@ -194,6 +222,6 @@ def get_book_detail_keyboard(book_id: int, in_library: bool = False, source: str
             [InlineKeyboardButton("🗑️ Удалить", callback_data=f"confirm_remove_{book_id}")]
         ])
     
-    keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="my_library")])
+    keyboard.append([_BACK_TO_LIBRARY])
     
     return InlineKeyboardMarkup(keyboard)
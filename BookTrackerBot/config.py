@@ -19,15 +19,43 @@ OPENLIBRARY_SEARCH_URL = f'{OPENLIBRARY_BASE_URL}/search.json'
 OPENLIBRARY_WORKS_URL = f'{OPENLIBRARY_BASE_URL}/works'
 OPENLIBRARY_COVERS_URL = 'https://covers.openlibrary.org/b/id'
 
+# HTTP-соединения с внешними источниками книг
+HTTP_POOL_CONNECTIONS = 32  # хостов с отдельным пулом соединений
+HTTP_POOL_MAXSIZE = 64  # соединений на хост
+HTTP_MAX_RETRIES = 3
+HTTP_RETRY_BACKOFF = 0.3  # секунды, растет вдвое с каждой попыткой
+
 # База данных
 DATABASE_PATH = 'books_library.db'
+DB_MAX_WORKERS = 4  # потоков для запросов к базе
+RECOMMENDATIONS_MAX_WORKERS = 2  # потоков для расчета TF-IDF рекомендаций
+# Соединение нужно каждому потоку БД и каждому потоку расчета рекомендаций (он читает кандидатов)
+DB_POOL_SIZE = DB_MAX_WORKERS + RECOMMENDATIONS_MAX_WORKERS
+DB_ROW_CACHE_TTL = 60  # секунды, для наличия книги в библиотеке
+DB_OPTIMIZE_INTERVAL = 1000  # обращений к пулу между запусками PRAGMA optimize
 
 # Пагинация
 BOOKS_PER_PAGE = 5
 SEARCH_RESULTS_PER_PAGE = 5
+USER_BOOKS_COUNT_CACHE_TTL = 60  # секунды
+USER_BOOKS_PAGE_CACHE_TTL = 60  # секунды
+USER_BOOKS_PAGE_CACHE_SIZE = 32  # страниц одного пользователя
+
+# Ручное добавление книги
+WIZARD_STATE_TTL = 3600  # секунды без ввода, после которых незавершенный ввод забывается
+WIZARD_STATE_MAX_USERS = 10000
 
 # Рекомендации
 MAX_RECOMMENDATIONS = 10
+RECOMMENDATIONS_CACHE_TTL = 60  # секунды
+RECOMMENDATIONS_CORPUS_TTL = 600  # секунды, для обученного на кандидатах TF-IDF
+# Сохраненный между перезапусками корпус кандидатов лежит рядом с файлом базы
+RECOMMENDATIONS_CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(DATABASE_PATH)), 'rec_cache.joblib')
+
+# Кэш результатов поиска во внешних источниках
+SEARCH_CACHE_SIZE = 2048  # запросов
+SEARCH_CACHE_TTL = 3600  # секунды
+SEARCH_EMPTY_CACHE_TTL = 30  # секунды, для пустых результатов и ошибок
 
 # Лимиты
 MAX_DESCRIPTION_LENGTH = 1000
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Асинхронный доступ к базе данных для обработчиков бота
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from config import DB_MAX_WORKERS
+from database import db
+
+# Отдельный пул потоков для SQLite: запросы к базе не конкурируют за общий пул
+# asyncio.to_thread с поиском во внешних источниках, а число одновременных
+# обращений к файлу базы ограничено
+_db_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix='db')
+
+async def run_in_db_thread(func, *args, **kwargs):
+    """Выполнение синхронной функции, работающей с БД, в пуле потоков базы"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+def _run_in_thread(func):
+    """Обертка, выполняющая синхронную функцию БД в пуле потоков базы"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_in_db_thread(func, *args, **kwargs)
+    return wrapper
+
+# Корутинные версии функций database.db: вызовы sqlite3 не блокируют цикл событий
+add_or_update_user = _run_in_thread(db.add_or_update_user)
+add_book_to_global = _run_in_thread(db.add_book_to_global)
+add_book_and_check = _run_in_thread(db.add_book_and_check)
+add_book_to_user_library = _run_in_thread(db.add_book_to_user_library)
+add_new_book_to_user_library = _run_in_thread(db.add_new_book_to_user_library)
+get_user_books = _run_in_thread(db.get_user_books)
+get_user_books_page = _run_in_thread(db.get_user_books_page)
+get_user_books_count = _run_in_thread(db.get_user_books_count)
+remove_book_from_user_library = _run_in_thread(db.remove_book_from_user_library)
+update_user_book_rating = _run_in_thread(db.update_user_book_rating)
+rate_user_book = _run_in_thread(db.rate_user_book)
+search_books_in_db = _run_in_thread(db.search_books_in_db)
+set_user_state = _run_in_thread(db.set_user_state)
+get_user_state = _run_in_thread(db.get_user_state)
+clear_user_state = _run_in_thread(db.clear_user_state)
+check_book_in_user_library = _run_in_thread(db.check_book_in_user_library)
@@ -4,343 +4,581 @@
 Модуль работы с базой данных SQLite
 """
 
+import functools
+import inspect
+import itertools
 import sqlite3
 import logging
-from typing import List, Dict, Optional, Tuple
+import queue
+import re
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Iterator, Optional, Tuple
 from datetime import datetime
-from config import DATABASE_PATH
+from config import (
+    DATABASE_PATH, DB_POOL_SIZE, DB_ROW_CACHE_TTL, DB_OPTIMIZE_INTERVAL,
+    USER_BOOKS_COUNT_CACHE_TTL, USER_BOOKS_PAGE_CACHE_TTL, USER_BOOKS_PAGE_CACHE_SIZE
+)
+from utils.cache import TTLCache
+from utils.formatting import add_display_fields
 
 logger = logging.getLogger(__name__)
 
+def log_db_errors(message: str):
+    """Декоратор: записывает в лог ошибку SQLite и передает её вызывающему коду.
+
+    В сообщение подставляются аргументы функции по имени, например "{user_id}";
+    форматирование выполняется только при ошибке.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.DatabaseError:
+                arguments = signature.bind(*args, **kwargs).arguments
+                logger.error(message.format(**arguments), exc_info=True)
+                raise
+        return wrapper
+    return decorator
+
+# Количество книг в библиотеке: {user_id: count}. Для пагинации точность до секунд не нужна,
+# а при изменении библиотеки запись сбрасывается
+_count_cache = TTLCache(maxsize=10000, ttl=USER_BOOKS_COUNT_CACHE_TTL)
+
+# Недавно показанные страницы библиотеки: {user_id: {(sort_by, limit, offset): [книги]}}.
+# Страницы сгруппированы по пользователю, чтобы изменение библиотеки сбрасывало их все сразу;
+# у каждого пользователя хранится не больше USER_BOOKS_PAGE_CACHE_SIZE последних страниц
+_page_cache = TTLCache(maxsize=1024, ttl=USER_BOOKS_PAGE_CACHE_TTL)
+
+# Наличие книги в библиотеке: {(user_id, book_id): bool}
+_membership_cache = TTLCache(maxsize=4096, ttl=DB_ROW_CACHE_TTL)
+
+def _invalidate_user_library(user_id: int, count_changed: bool = True, book_ids: Tuple[int, ...] = ()):
+    """Сброс кэшей библиотеки пользователя после её изменения"""
+    _page_cache.pop(user_id)
+    if count_changed:
+        _count_cache.pop(user_id)
+    for book_id in book_ids:
+        _membership_cache.pop((user_id, book_id))
+
+# Пул соединений: открытие файла базы на каждый запрос обходится дороже самого запроса.
+# Соединения создаются по мере надобности, но не больше DB_POOL_SIZE
+_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=DB_POOL_SIZE)
+_pool_lock = threading.Lock()
+_pool_created = 0
+
+# Счетчик выдачи соединений: раз в DB_OPTIMIZE_INTERVAL обращений соединение перед возвратом
+# в пул выполняет PRAGMA optimize, чтобы статистика планировщика успевала за ростом таблиц
+_checkouts = itertools.count(1)
+
+def _acquire_connection() -> sqlite3.Connection:
+    """Свободное соединение из пула или новое, пока пул не заполнен"""
+    global _pool_created
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        pass
+    
+    with _pool_lock:
+        if _pool_created < DB_POOL_SIZE:
+            # Соединение передается между потоками пула, но используется одним потоком за раз
+            conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False, cached_statements=256)
+            # Строки доступны и по индексу, и по имени столбца; dict(row) собирается на стороне C
+            conn.row_factory = sqlite3.Row
+            # Настройки действуют на соединение, поэтому задаются каждому соединению пула
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA temp_store=MEMORY')
+            conn.execute('PRAGMA mmap_size=268435456')
+            conn.execute('PRAGMA cache_size=-65536')
+            _pool_created += 1
+            return conn
+    
+    return _pool.get()
+
+@contextmanager
 def get_connection():
-    """Получение соединения с базой данных"""
-    return sqlite3.connect(DATABASE_PATH)
+    """Соединение с базой данных из пула; при выходе транзакция фиксируется или откатывается"""
+    conn = _acquire_connection()
+    try:
+        with conn:
+            yield conn
+    finally:
+        if next(_checkouts) % DB_OPTIMIZE_INTERVAL == 0:
+            try:
+                conn.execute('PRAGMA optimize')
+            except sqlite3.DatabaseError:
+                logger.warning("Не удалось выполнить PRAGMA optimize", exc_info=True)
+        _pool.put(conn)
+
+# Запросы, выполняемые на каждое действие пользователя. Текст задан один раз,
+# поэтому разобранные выражения переиспользуются из кэша соединения.
+# Существующие строки обновляются на месте через ON CONFLICT: INSERT OR REPLACE удалял бы
+# строку и вставлял заново, переписывая индексы и сбрасывая даты создания
+UPSERT_USER_QUERY = '''
+    INSERT INTO users (user_id, username, first_name, last_name)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = excluded.username, first_name = excluded.first_name, last_name = excluded.last_name
+'''
+UPSERT_BOOK_QUERY = '''
+    INSERT INTO books (title, author, genre, description, openlibrary_id, cover_url, publication_year)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (openlibrary_id) DO UPDATE SET openlibrary_id = excluded.openlibrary_id
+    RETURNING id
+'''
+INSERT_BOOK_QUERY = '''
+    INSERT INTO books (title, author, genre, description, openlibrary_id, cover_url, publication_year)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+UPSERT_USER_BOOK_QUERY = '''
+    INSERT INTO user_books (user_id, book_id, user_rating, user_notes)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id, book_id) DO UPDATE SET
+        user_rating = excluded.user_rating, user_notes = excluded.user_notes
+'''
+INSERT_USER_BOOK_RATING_QUERY = 'INSERT INTO user_books (user_id, book_id, user_rating) VALUES (?, ?, ?)'
+UPDATE_USER_BOOK_RATING_QUERY = 'UPDATE user_books SET user_rating = ? WHERE user_id = ? AND book_id = ?'
+DELETE_USER_BOOK_QUERY = 'DELETE FROM user_books WHERE user_id = ? AND book_id = ?'
+CHECK_USER_BOOK_QUERY = 'SELECT EXISTS(SELECT 1 FROM user_books WHERE user_id = ? AND book_id = ?)'
+COUNT_USER_BOOKS_QUERY = 'SELECT COUNT(*) FROM user_books WHERE user_id = ?'
+GET_BOOK_QUERY = '''
+    SELECT id, title, author, genre, description, cover_url, publication_year
+    FROM books WHERE id = ?
+'''
+SET_USER_STATE_QUERY = '''
+    INSERT INTO user_states (user_id, state, data, updated_at)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE SET
+        state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+'''
+GET_USER_STATE_QUERY = 'SELECT state, data FROM user_states WHERE user_id = ?'
+CLEAR_USER_STATE_QUERY = 'DELETE FROM user_states WHERE user_id = ?'
+
+# Схема базы данных. Выполняется одним executescript внутри одной транзакции:
+# при ошибке не остается наполовину созданной схемы
+SCHEMA_SCRIPT = '''
+BEGIN;
+
+-- Таблица пользователей
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Таблица книг в глобальной базе
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    author TEXT NOT NULL,
+    genre TEXT,
+    description TEXT,
+    openlibrary_id TEXT UNIQUE,
+    cover_url TEXT,
+    publication_year INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Таблица личных библиотек пользователей
+CREATE TABLE IF NOT EXISTS user_books (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    book_id INTEGER NOT NULL,
+    user_rating INTEGER CHECK(user_rating >= 1 AND user_rating <= 10),
+    user_notes TEXT,
+    date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    genre TEXT,
+    FOREIGN KEY (user_id) REFERENCES users (user_id),
+    FOREIGN KEY (book_id) REFERENCES books (id),
+    UNIQUE(user_id, book_id)
+);
+
+-- Жанр книги дублируется в user_books, чтобы статистика жанров пользователя
+-- читала одну узкую таблицу без соединения с books
+CREATE TRIGGER IF NOT EXISTS user_books_genre_insert AFTER INSERT ON user_books BEGIN
+    UPDATE user_books SET genre = (SELECT genre FROM books WHERE id = new.book_id)
+    WHERE id = new.id;
+END;
+CREATE TRIGGER IF NOT EXISTS books_genre_update AFTER UPDATE OF genre ON books BEGIN
+    UPDATE user_books SET genre = new.genre WHERE book_id = new.id;
+END;
+
+-- Таблица состояний пользователей для мультишагового диалога
+CREATE TABLE IF NOT EXISTS user_states (
+    user_id INTEGER PRIMARY KEY,
+    state TEXT,
+    data TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (user_id)
+);
+
+-- Индексы для постраничного вывода библиотеки пользователя
+CREATE INDEX IF NOT EXISTS idx_user_books_user_date ON user_books (user_id, date_added);
+CREATE INDEX IF NOT EXISTS idx_user_books_user_rating ON user_books (user_id, user_rating);
+
+-- Индексы для поиска книг по названию, автору и жанру без учета регистра
+CREATE INDEX IF NOT EXISTS idx_books_title_nocase ON books (title COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_books_author_nocase ON books (author COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_books_genre_nocase ON books (genre COLLATE NOCASE);
+
+-- Частичный индекс ID книг с описанием: из них выбираются кандидаты для рекомендаций
+CREATE INDEX IF NOT EXISTS idx_books_with_description ON books (id)
+    WHERE description IS NOT NULL AND description != '';
 
+-- Полнотекстовый индекс книг. Содержимое хранится в books, индекс обновляют триггеры
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    title, author, genre, description,
+    content='books', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+    INSERT INTO books_fts (rowid, title, author, genre, description)
+    VALUES (new.id, new.title, new.author, new.genre, new.description);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+    INSERT INTO books_fts (books_fts, rowid, title, author, genre, description)
+    VALUES ('delete', old.id, old.title, old.author, old.genre, old.description);
+END;
+CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title, author, genre, description ON books BEGIN
+    INSERT INTO books_fts (books_fts, rowid, title, author, genre, description)
+    VALUES ('delete', old.id, old.title, old.author, old.genre, old.description);
+    INSERT INTO books_fts (rowid, title, author, genre, description)
+    VALUES (new.id, new.title, new.author, new.genre, new.description);
+END;
+
+COMMIT;
+'''
+
+@log_db_errors("Ошибка при инициализации базы данных")
 def init_database():
     """Инициализация базы данных и создание таблиц"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Таблица пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Таблица книг в глобальной базе
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS books (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    title TEXT NOT NULL,
-                    author TEXT NOT NULL,
-                    genre TEXT,
-                    description TEXT,
-                    openlibrary_id TEXT UNIQUE,
-                    cover_url TEXT,
-                    publication_year INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Таблица личных библиотек пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_books (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    book_id INTEGER NOT NULL,
-                    user_rating INTEGER CHECK(user_rating >= 1 AND user_rating <= 10),
-                    user_notes TEXT,
-                    date_added TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id),
-                    FOREIGN KEY (book_id) REFERENCES books (id),
-                    UNIQUE(user_id, book_id)
-                )
-            ''')
-            
-            # Таблица состояний пользователей для мультишагового диалога
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_states (
-                    user_id INTEGER PRIMARY KEY,
-                    state TEXT,
-                    data TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
-            
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Журнал WAL: чтение не блокируется записью, а фиксация транзакции - дозапись в журнал.
+        # Вместе с synchronous=NORMAL последние транзакции могут пропасть при сбое питания
+        # (но не при падении процесса) до ближайшей контрольной точки; целостность базы сохраняется
+        journal_mode = cursor.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            logger.warning("Не удалось включить журнал WAL, используется режим %s", journal_mode)
+        
+        # Базы, созданные до появления user_books.genre: добавляем столбец и заполняем его
+        cursor.execute('PRAGMA table_info(user_books)')
+        user_books_columns = {column['name'] for column in cursor.fetchall()}
+        if user_books_columns and 'genre' not in user_books_columns:
+            cursor.execute('ALTER TABLE user_books ADD COLUMN genre TEXT')
+            cursor.execute('UPDATE user_books SET genre = (SELECT genre FROM books WHERE books.id = user_books.book_id)')
             conn.commit()
-            logger.info("База данных успешно инициализирована")
-            
-    except Exception as e:
-        logger.error(f"Ошибка при инициализации базы данных: {e}")
-        raise
+        
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'books_fts'")
+        fts_exists = cursor.fetchone() is not None
+        
+        cursor.executescript(SCHEMA_SCRIPT)
+        
+        if not fts_exists:
+            # Индексируем книги, добавленные до появления полнотекстового поиска
+            cursor.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+        
+        conn.commit()
+        # Статистика для планировщика: без нее SQLite может не выбрать новые индексы
+        cursor.execute('ANALYZE')
+        logger.info("База данных успешно инициализирована")
 
+@log_db_errors("Ошибка при добавлении/обновлении пользователя {user_id}")
 def add_or_update_user(user_id: int, username: str = None, first_name: str = None, last_name: str = None):
     """Добавление или обновление пользователя"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO users (user_id, username, first_name, last_name)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, username, first_name, last_name))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при добавлении/обновлении пользователя {user_id}: {e}")
-        raise
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPSERT_USER_QUERY, (user_id, username, first_name, last_name))
+        conn.commit()
 
+@log_db_errors("Ошибка при добавлении книги в глобальную базу")
 def add_book_to_global(title: str, author: str, genre: str = None, description: str = None, 
                       openlibrary_id: str = None, cover_url: str = None, 
                       publication_year: int = None) -> int:
-    """Добавление книги в глобальную базу"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO books (title, author, genre, description, openlibrary_id, cover_url, publication_year)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (title, author, genre, description, openlibrary_id, cover_url, publication_year))
-            conn.commit()
-            return cursor.lastrowid
-    except sqlite3.IntegrityError:
-        # Книга уже существует, возвращаем её ID
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT id FROM books WHERE openlibrary_id = ?', (openlibrary_id,))
-            result = cursor.fetchone()
-            return result[0] if result else None
-    except Exception as e:
-        logger.error(f"Ошибка при добавлении книги в глобальную базу: {e}")
-        raise
+    """Добавление книги в глобальную базу; для уже известной книги возвращает её ID"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Пустое обновление при конфликте нужно только для того, чтобы RETURNING вернул ID существующей книги
+        cursor.execute(UPSERT_BOOK_QUERY,
+                       (title, author, genre, description, openlibrary_id, cover_url, publication_year))
+        return cursor.fetchone()[0]
+
+@log_db_errors("Ошибка при сохранении книги и проверке библиотеки пользователя {user_id}")
+def add_book_and_check(user_id: int, book: Dict, book_id: Optional[int] = None) -> Tuple[Optional[int], bool]:
+    """Сохранение книги в глобальной базе и проверка ее наличия в библиотеке пользователя одной транзакцией.
+
+    Если book_id уже известен (книга сохранена при прошлом выборе), выполняется только проверка.
+    Возвращает ID книги и признак того, что книга уже в библиотеке.
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        if book_id is None:
+            row = (book.get('title', ''), book.get('author', ''), book.get('genre', ''),
+                   book.get('description', ''),
+                   # Пустой внешний ID сохраняем как NULL, иначе такие книги склеятся по UNIQUE
+                   book.get('external_id') or None,
+                   book.get('cover_url', ''), book.get('first_publish_year'))
+            if row[4] is not None:
+                book_id = cursor.execute(UPSERT_BOOK_QUERY, row).fetchone()[0]
+            else:
+                cursor.execute(INSERT_BOOK_QUERY, row)
+                book_id = cursor.lastrowid
+        
+        cursor.execute(CHECK_USER_BOOK_QUERY, (user_id, book_id))
+        in_library = bool(cursor.fetchone()[0])
+    
+    _membership_cache[(user_id, book_id)] = in_library
+    return book_id, in_library
 
+@log_db_errors("Ошибка при добавлении новой книги в библиотеку пользователя {user_id}")
+def add_new_book_to_user_library(user_id: int, book: Dict, rating: int = None) -> int:
+    """Добавление введенной вручную книги в глобальную базу и в библиотеку пользователя одной транзакцией"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # У книги без внешнего ID не бывает конфликта, поэтому достаточно простой вставки
+        cursor.execute(INSERT_BOOK_QUERY,
+                       (book.get('title', ''), book.get('author', ''), book.get('genre'),
+                        book.get('description'), None, None, None))
+        book_id = cursor.lastrowid
+        cursor.execute(UPSERT_USER_BOOK_QUERY, (user_id, book_id, rating, None))
+    
+    _invalidate_user_library(user_id, book_ids=(book_id,))
+    return book_id
+
+@log_db_errors("Ошибка при добавлении книги в библиотеку пользователя {user_id}")
 def add_book_to_user_library(user_id: int, book_id: int, rating: int = None, notes: str = None):
     """Добавление книги в личную библиотеку пользователя"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPSERT_USER_BOOK_QUERY, (user_id, book_id, rating, notes))
+        conn.commit()
+    _invalidate_user_library(user_id, book_ids=(book_id,))
+
+def _user_book_from_row(row: sqlite3.Row) -> Dict:
+    """Преобразование строки выборки книг пользователя в словарь"""
+    return add_display_fields(dict(row))
+
+USER_BOOKS_QUERY = '''
+    SELECT b.id, b.title, b.author, b.genre, b.description, b.cover_url, 
+           b.publication_year, ub.user_rating, ub.user_notes, ub.date_added
+    FROM user_books ub
+    JOIN books b ON ub.book_id = b.id
+    WHERE ub.user_id = ?
+'''
+
+# ORDER BY для списка книг пользователя; неизвестная сортировка - по дате добавления
+USER_BOOKS_ORDER_BY = {
+    'title': ' ORDER BY b.title',
+    'author': ' ORDER BY b.author',
+    'genre': ' ORDER BY b.genre',
+    'rating': ' ORDER BY ub.user_rating DESC',
+    'date_added': ' ORDER BY ub.date_added DESC',
+}
+
+# Готовые тексты запросов для каждой сортировки: один и тот же текст попадает в кэш
+# выражений соединения, а не собирается заново при каждом вызове
+USER_BOOKS_SEARCH_CLAUSE = ' AND b.id IN (SELECT rowid FROM books_fts WHERE books_fts MATCH ?)'
+USER_BOOKS_QUERIES = {sort_by: USER_BOOKS_QUERY + order_by for sort_by, order_by in USER_BOOKS_ORDER_BY.items()}
+USER_BOOKS_SEARCH_QUERIES = {
+    sort_by: USER_BOOKS_QUERY + USER_BOOKS_SEARCH_CLAUSE + order_by
+    for sort_by, order_by in USER_BOOKS_ORDER_BY.items()
+}
+USER_BOOKS_PAGE_QUERIES = {
+    sort_by: USER_BOOKS_QUERY + order_by + ' LIMIT ? OFFSET ?'
+    for sort_by, order_by in USER_BOOKS_ORDER_BY.items()
+}
+
+def iter_user_books(user_id: int, sort_by: str = 'date_added', search_query: str = None) -> Iterator[Dict]:
+    """Книги пользователя по одной, по мере чтения курсора, без загрузки всей выборки в память.
+
+    Соединение остается занятым, пока генератор не исчерпан или не закрыт,
+    поэтому результат нужно перебирать сразу, не откладывая.
+    """
+    if search_query:
+        match_query = _fts_match_query(search_query)
+        if match_query is None:
+            return
+        query = USER_BOOKS_SEARCH_QUERIES.get(sort_by, USER_BOOKS_SEARCH_QUERIES['date_added'])
+        params = (user_id, match_query)
+    else:
+        query = USER_BOOKS_QUERIES.get(sort_by, USER_BOOKS_QUERIES['date_added'])
+        params = (user_id,)
+    
     try:
         with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_books (user_id, book_id, user_rating, user_notes)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, book_id, rating, notes))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при добавлении книги в библиотеку пользователя {user_id}: {e}")
+            for row in conn.execute(query, params):
+                yield _user_book_from_row(row)
+    except sqlite3.DatabaseError:
+        logger.error("Ошибка при получении книг пользователя %s", user_id, exc_info=True)
         raise
 
 def get_user_books(user_id: int, sort_by: str = 'date_added', search_query: str = None) -> List[Dict]:
     """Получение книг пользователя с сортировкой и поиском"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            
-            base_query = '''
-                SELECT b.id, b.title, b.author, b.genre, b.description, b.cover_url, 
-                       b.publication_year, ub.user_rating, ub.user_notes, ub.date_added
-                FROM user_books ub
-                JOIN books b ON ub.book_id = b.id
-                WHERE ub.user_id = ?
-            '''
-            
-            params = [user_id]
-            
-            # Добавление поиска
-            if search_query:
-                base_query += ' AND (b.title LIKE ? OR b.author LIKE ? OR b.genre LIKE ?)'
-                search_pattern = f'%{search_query}%'
-                params.extend([search_pattern, search_pattern, search_pattern])
-            
-            # Добавление сортировки
-            if sort_by == 'title':
-                base_query += ' ORDER BY b.title'
-            elif sort_by == 'author':
-                base_query += ' ORDER BY b.author'
-            elif sort_by == 'genre':
-                base_query += ' ORDER BY b.genre'
-            elif sort_by == 'rating':
-                base_query += ' ORDER BY ub.user_rating DESC'
-            else:  # date_added
-                base_query += ' ORDER BY ub.date_added DESC'
-            
-            cursor.execute(base_query, params)
-            rows = cursor.fetchall()
-            
-            books = []
-            for row in rows:
-                books.append({
-                    'id': row[0],
-                    'title': row[1],
-                    'author': row[2],
-                    'genre': row[3],
-                    'description': row[4],
-                    'cover_url': row[5],
-                    'publication_year': row[6],
-                    'user_rating': row[7],
-                    'user_notes': row[8],
-                    'date_added': row[9]
-                })
-            
-            return books
-            
-    except Exception as e:
-        logger.error(f"Ошибка при получении книг пользователя {user_id}: {e}")
-        raise
+    return list(iter_user_books(user_id, sort_by, search_query))
 
+@log_db_errors("Ошибка при получении страницы книг пользователя {user_id}")
+def get_user_books_page(user_id: int, sort_by: str = 'date_added', limit: int = 5, offset: int = 0) -> List[Dict]:
+    """Получение одной страницы книг пользователя"""
+    # Неизвестная сортировка выполняется как по дате добавления и хранится под тем же ключом
+    if sort_by not in USER_BOOKS_PAGE_QUERIES:
+        sort_by = 'date_added'
+    
+    pages = _page_cache.get(user_id)
+    if pages is None:
+        pages = TTLCache(maxsize=USER_BOOKS_PAGE_CACHE_SIZE, ttl=USER_BOOKS_PAGE_CACHE_TTL)
+        _page_cache[user_id] = pages
+    
+    page_key = (sort_by, limit, offset)
+    books = pages.get(page_key)
+    if books is not None:
+        return books
+    
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(USER_BOOKS_PAGE_QUERIES[sort_by], (user_id, limit, offset))
+        books = [_user_book_from_row(row) for row in cursor.fetchall()]
+    pages[page_key] = books
+    return books
+
+@log_db_errors("Ошибка при подсчете книг пользователя {user_id}")
+def get_user_books_count(user_id: int) -> int:
+    """Количество книг в библиотеке пользователя"""
+    count = _count_cache.get(user_id)
+    if count is not None:
+        return count
+    
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(COUNT_USER_BOOKS_QUERY, (user_id,))
+        count = cursor.fetchone()[0]
+    _count_cache[user_id] = count
+    return count
+
+@log_db_errors("Ошибка при получении книги по ID {book_id}")
 def get_book_by_id(book_id: int) -> Optional[Dict]:
     """Получение книги по ID"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT id, title, author, genre, description, cover_url, publication_year
-                FROM books WHERE id = ?
-            ''', (book_id,))
-            row = cursor.fetchone()
-            
-            if row:
-                return {
-                    'id': row[0],
-                    'title': row[1],
-                    'author': row[2],
-                    'genre': row[3],
-                    'description': row[4],
-                    'cover_url': row[5],
-                    'publication_year': row[6]
-                }
-            return None
-            
-    except Exception as e:
-        logger.error(f"Ошибка при получении книги по ID {book_id}: {e}")
-        raise
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(GET_BOOK_QUERY, (book_id,))
+        row = cursor.fetchone()
+    return dict(row) if row is not None else None
 
+@log_db_errors("Ошибка при удалении книги из библиотеки пользователя {user_id}")
 def remove_book_from_user_library(user_id: int, book_id: int):
     """Удаление книги из личной библиотеки пользователя"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM user_books WHERE user_id = ? AND book_id = ?', 
-                         (user_id, book_id))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при удалении книги из библиотеки пользователя {user_id}: {e}")
-        raise
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(DELETE_USER_BOOK_QUERY, (user_id, book_id))
+        conn.commit()
+    _invalidate_user_library(user_id, book_ids=(book_id,))
 
+@log_db_errors("Ошибка при обновлении оценки книги")
 def update_user_book_rating(user_id: int, book_id: int, rating: int):
     """Обновление оценки книги пользователем"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE user_books SET user_rating = ? 
-                WHERE user_id = ? AND book_id = ?
-            ''', (rating, user_id, book_id))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении оценки книги: {e}")
-        raise
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPDATE_USER_BOOK_RATING_QUERY, (rating, user_id, book_id))
+        conn.commit()
+    _invalidate_user_library(user_id, count_changed=False)
 
+@log_db_errors("Ошибка при оценке книги {book_id} пользователем {user_id}")
+def rate_user_book(user_id: int, book_id: int, rating: int) -> bool:
+    """Оценка книги: обновляет оценку или добавляет книгу в библиотеку; True, если книга добавлена"""
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPDATE_USER_BOOK_RATING_QUERY, (rating, user_id, book_id))
+        
+        added = not cursor.rowcount
+        if added:
+            cursor.execute(INSERT_USER_BOOK_RATING_QUERY, (user_id, book_id, rating))
+        conn.commit()
+    
+    _invalidate_user_library(user_id, count_changed=added, book_ids=(book_id,))
+    return added
+
+@log_db_errors("Ошибка при получении жанров пользователя {user_id}")
 def get_user_genres_and_ratings(user_id: int) -> List[Tuple[str, float]]:
     """Получение жанров и средних оценок пользователя для рекомендаций"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT b.genre, AVG(ub.user_rating) as avg_rating, COUNT(*) as count
-                FROM user_books ub
-                JOIN books b ON ub.book_id = b.id
-                WHERE ub.user_id = ? AND b.genre IS NOT NULL AND ub.user_rating IS NOT NULL
-                GROUP BY b.genre
-                ORDER BY avg_rating DESC, count DESC
-            ''', (user_id,))
-            
-            return cursor.fetchall()
-            
-    except Exception as e:
-        logger.error(f"Ошибка при получении жанров пользователя {user_id}: {e}")
-        raise
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT genre, AVG(user_rating) as avg_rating, COUNT(*) as count
+            FROM user_books
+            WHERE user_id = ? AND genre IS NOT NULL AND user_rating IS NOT NULL
+            GROUP BY genre
+            ORDER BY avg_rating DESC, count DESC
+        ''', (user_id,))
+        
+        return cursor.fetchall()
+
+def _fts_match_query(text: str) -> Optional[str]:
+    """Запрос FTS5 по названию, автору и жанру: все слова как префиксы"""
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+    terms = ' '.join(f'"{word}"*' for word in words)
+    return f'{{title author genre}} : ({terms})'
 
+@log_db_errors("Ошибка при поиске книг в БД")
 def search_books_in_db(query: str, limit: int = 10) -> List[Dict]:
     """Поиск книг в локальной базе данных"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            search_pattern = f'%{query}%'
-            cursor.execute('''
-                SELECT id, title, author, genre, description, cover_url, publication_year
-                FROM books 
-                WHERE title LIKE ? OR author LIKE ? OR genre LIKE ?
-                LIMIT ?
-            ''', (search_pattern, search_pattern, search_pattern, limit))
-            
-            rows = cursor.fetchall()
-            books = []
-            for row in rows:
-                books.append({
-                    'id': row[0],
-                    'title': row[1],
-                    'author': row[2],
-                    'genre': row[3],
-                    'description': row[4],
-                    'cover_url': row[5],
-                    'publication_year': row[6]
-                })
-            
-            return books
-            
-    except Exception as e:
-        logger.error(f"Ошибка при поиске книг в БД: {e}")
-        raise
+    match_query = _fts_match_query(query)
+    if match_query is None:
+        return []
+    
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT b.id, b.title, b.author, b.genre, b.description, b.cover_url, b.publication_year
+            FROM books_fts
+            JOIN books b ON b.id = books_fts.rowid
+            WHERE books_fts MATCH ?
+            ORDER BY books_fts.rank
+            LIMIT ?
+        ''', (match_query, limit))
+        
+        return [dict(row) for row in cursor.fetchall()]
 
+@log_db_errors("Ошибка при установке состояния пользователя {user_id}")
 def set_user_state(user_id: int, state: str, data: str = None):
     """Установка состояния пользователя для мультишагового диалога"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO user_states (user_id, state, data, updated_at)
-                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-            ''', (user_id, state, data))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при установке состояния пользователя {user_id}: {e}")
-        raise
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SET_USER_STATE_QUERY, (user_id, state, data))
+        conn.commit()
 
+@log_db_errors("Ошибка при получении состояния пользователя {user_id}")
 def get_user_state(user_id: int) -> Optional[Tuple[str, str]]:
     """Получение состояния пользователя"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT state, data FROM user_states WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-            return result if result else (None, None)
-    except Exception as e:
-        logger.error(f"Ошибка при получении состояния пользователя {user_id}: {e}")
-        raise
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(GET_USER_STATE_QUERY, (user_id,))
+        result = cursor.fetchone()
+        return result if result else (None, None)
 
+@log_db_errors("Ошибка при очистке состояния пользователя {user_id}")
 def clear_user_state(user_id: int):
     """Очистка состояния пользователя"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
-            conn.commit()
-    except Exception as e:
-        logger.error(f"Ошибка при очистке состояния пользователя {user_id}: {e}")
-        raise
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CLEAR_USER_STATE_QUERY, (user_id,))
+        conn.commit()
 
+@log_db_errors("Ошибка при проверке книги в библиотеке")
 def check_book_in_user_library(user_id: int, book_id: int) -> bool:
     """Проверка наличия книги в библиотеке пользователя"""
-    try:
-        with get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT 1 FROM user_books WHERE user_id = ? AND book_id = ?', 
-                         (user_id, book_id))
-            return cursor.fetchone() is not None
-    except Exception as e:
-        logger.error(f"Ошибка при проверке книги в библиотеке: {e}")
-        raise
+    in_library = _membership_cache.get((user_id, book_id))
+    if in_library is not None:
+        return in_library
+    
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CHECK_USER_BOOK_QUERY, (user_id, book_id))
+        in_library = bool(cursor.fetchone()[0])
+    _membership_cache[(user_id, book_id)] = in_library
+    return in_library
@@ -6,7 +6,9 @@ Telegram бот для учета прочитанных книг с реком
 
 import logging
 import os
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+from telegram.ext import (
+    AIORateLimiter, Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+)
 from config import BOT_TOKEN
 from database.db import init_database
 from bot.handlers import (
@@ -29,23 +31,32 @@ def main():
         init_database()
         logger.info("База данных инициализирована")
         
-        # Создание приложения
-        application = Application.builder().token(BOT_TOKEN).build()
+        # Создание приложения. Все исходящие запросы к Bot API проходят через
+        # AIORateLimiter: он выдерживает лимиты Telegram (30 сообщений/с всего,
+        # 20 сообщений/мин в группу) и сам повторяет запросы после RetryAfter
+        rate_limiter = AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+        )
+        application = Application.builder().token(BOT_TOKEN).rate_limiter(rate_limiter).build()
         
-        # Добавление обработчиков команд
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("add", add_book_command))
-        application.add_handler(CommandHandler("library", my_library_command))
-        application.add_handler(CommandHandler("recommendations", recommendations_command))
-        application.add_handler(CommandHandler("search", search_books_command))
-        application.add_handler(CommandHandler("cancel", cancel_command))
+        # Добавление обработчиков команд. Обработчики запускаются с block=False:
+        # долгий поиск одного пользователя не задерживает обновления остальных
+        application.add_handler(CommandHandler("start", start, block=False))
+        application.add_handler(CommandHandler("help", help_command, block=False))
+        application.add_handler(CommandHandler("add", add_book_command, block=False))
+        application.add_handler(CommandHandler("library", my_library_command, block=False))
+        application.add_handler(CommandHandler("recommendations", recommendations_command, block=False))
+        application.add_handler(CommandHandler("search", search_books_command, block=False))
+        application.add_handler(CommandHandler("cancel", cancel_command, block=False))
         
         # Обработчик callback запросов (для inline клавиатур)
-        application.add_handler(CallbackQueryHandler(handle_callback_query))
+        application.add_handler(CallbackQueryHandler(handle_callback_query, block=False))
         
         # Обработчик текстовых сообщений
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message, block=False))
         
         logger.info("Бот запускается...")
         
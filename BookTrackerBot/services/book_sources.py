@@ -4,10 +4,17 @@
 Модуль интеграции с различными источниками книг
 """
 
+import asyncio
 import requests
 import logging
+import orjson
 from typing import List, Dict, Optional
 from abc import ABC, abstractmethod
+from config import SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_EMPTY_CACHE_TTL
+from services.openlibrary import QUOTES_TABLE, openlibrary_api
+from utils.cache import TTLCache
+from utils.formatting import join_authors
+from utils.http import http_session
 
 logger = logging.getLogger(__name__)
 
@@ -25,140 +32,24 @@ class BookSource(ABC):
         pass
 
 class OpenLibrarySource(BookSource):
-    """Источник Open Library"""
+    """Источник Open Library; поиск выполняет общий клиент services.openlibrary"""
     
     def __init__(self):
-        self.base_url = 'https://openlibrary.org'
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'BookBot/1.0 (Contact: your-email@example.com)'
-        })
+        self._api = openlibrary_api
     
     def search_books(self, query: str, limit: int = 5) -> List[Dict]:
         """Поиск книг в Open Library"""
-        try:
-            # Улучшаем поисковый запрос
-            formatted_query = self._format_search_query(query)
-            
-            params = {
-                'q': formatted_query,
-                'limit': limit,
-                'fields': 'key,title,author_name,first_publish_year,subject,cover_i,edition_count'
-            }
-            
-            # Делаем несколько попыток с разными форматами запроса
-            search_attempts = [
-                formatted_query,
-                f'author:"{query}"',
-                f'title:"{query}"',
-                query.replace(' ', '+')
-            ]
-            
-            for attempt_query in search_attempts:
-                try:
-                    params['q'] = attempt_query
-                    response = self.session.get(f'{self.base_url}/search.json', params=params, timeout=10)
-                    response.raise_for_status()
-                    
-                    data = response.json()
-                    books = []
-                    
-                    for doc in data.get('docs', []):
-                        book = self._format_book_data(doc)
-                        if book:
-                            books.append(book)
-                    
-                    if books:
-                        logger.info(f"Open Library: найдено {len(books)} книг")
-                        return books
-                        
-                except requests.RequestException as e:
-                    logger.warning(f"Open Library попытка поиска неудачна: {e}")
-                    continue
-            
-            return []
-            
-        except Exception as e:
-            logger.error(f"Ошибка в Open Library: {e}")
-            return []
+        return self._api.search_books(query, limit)
     
     def get_source_name(self) -> str:
         return "📚 Open Library"
-    
-    def _format_search_query(self, query: str) -> str:
-        """Форматирование поискового запроса"""
-        query = query.strip()
-        query = query.replace('"', '').replace("'", "")
-        
-        if len(query.split()) == 1 and len(query) > 2:
-            return f'author:{query}'
-        
-        return query
-    
-    def _format_book_data(self, doc: Dict) -> Optional[Dict]:
-        """Форматирование данных книги"""
-        try:
-            title = doc.get('title', '').strip()
-            if not title:
-                return None
-            
-            authors = doc.get('author_name', [])
-            author = ', '.join(authors) if authors else 'Неизвестный автор'
-            
-            # Извлекаем жанр
-            subjects = doc.get('subject', [])
-            genre = self._extract_genre(subjects)
-            
-            # URL обложки
-            cover_url = None
-            cover_id = doc.get('cover_i')
-            if cover_id:
-                cover_url = f"https://covers.openlibrary.org/b/id/{cover_id}-M.jpg"
-            
-            return {
-                'source': 'openlibrary',
-                'external_id': doc.get('key', ''),
-                'title': title,
-                'author': author,
-                'genre': genre,
-                'description': '',  # Open Library не всегда предоставляет описание в поиске
-                'first_publish_year': doc.get('first_publish_year'),
-                'cover_url': cover_url,
-                'edition_count': doc.get('edition_count', 0)
-            }
-            
-        except Exception as e:
-            logger.error(f"Ошибка при форматировании данных Open Library: {e}")
-            return None
-    
-    def _extract_genre(self, subjects: List[str]) -> str:
-        """Извлечение жанра"""
-        if not subjects:
-            return 'Не указан'
-        
-        genre_map = {
-            'Fiction': 'Художественная литература',
-            'Science Fiction': 'Научная фантастика',
-            'Fantasy': 'Фэнтези',
-            'Mystery': 'Детектив',
-            'Romance': 'Роман',
-            'Biography': 'Биография',
-            'History': 'История'
-        }
-        
-        for subject in subjects[:5]:
-            for eng, rus in genre_map.items():
-                if eng.lower() in subject.lower():
-                    return rus
-        
-        return subjects[0] if subjects else 'Не указан'
 
 class GoogleBooksSource(BookSource):
     """Источник Google Books API"""
     
     def __init__(self):
         self.base_url = 'https://www.googleapis.com/books/v1/volumes'
-        self.session = requests.Session()
+        self.session = http_session
     
     def search_books(self, query: str, limit: int = 5) -> List[Dict]:
         """Поиск книг в Google Books"""
@@ -167,7 +58,10 @@ class GoogleBooksSource(BookSource):
                 'q': query,
                 'maxResults': min(limit, 40),
                 'printType': 'books',
-                'langRestrict': 'ru'  # Сначала ищем на русском
+                'langRestrict': 'ru',  # Сначала ищем на русском
+                # Частичный ответ: только поля, которые читает _format_book_data
+                'fields': 'items(id,volumeInfo(title,authors,categories,description,'
+                          'imageLinks(thumbnail,smallThumbnail),publishedDate,pageCount))'
             }
             
             # Пробуем русский и английский запросы
@@ -178,7 +72,7 @@ class GoogleBooksSource(BookSource):
                     response = self.session.get(self.base_url, params=params, timeout=10)
                     response.raise_for_status()
                     
-                    data = response.json()
+                    data = orjson.loads(response.content)
                     books = []
                     
                     for item in data.get('items', [])[:limit]:
@@ -187,17 +81,17 @@ class GoogleBooksSource(BookSource):
                             books.append(book)
                     
                     if books:
-                        logger.info(f"Google Books: найдено {len(books)} книг")
+                        logger.info("Google Books: найдено %d книг", len(books))
                         return books
                         
                 except requests.RequestException as e:
-                    logger.warning(f"Google Books попытка поиска неудачна: {e}")
+                    logger.warning("Google Books попытка поиска неудачна: %s", e)
                     continue
             
             return []
             
         except Exception as e:
-            logger.error(f"Ошибка в Google Books: {e}")
+            logger.error("Ошибка в Google Books: %s", e)
             return []
     
     def get_source_name(self) -> str:
@@ -213,7 +107,7 @@ class GoogleBooksSource(BookSource):
                 return None
             
             authors = volume_info.get('authors', [])
-            author = ', '.join(authors) if authors else 'Неизвестный автор'
+            author = join_authors(authors)
             
             # Категории как жанры
             categories = volume_info.get('categories', [])
@@ -229,13 +123,9 @@ class GoogleBooksSource(BookSource):
             cover_url = image_links.get('thumbnail', image_links.get('smallThumbnail'))
             
             # Год публикации
-            published_date = volume_info.get('publishedDate', '')
-            year = None
-            if published_date:
-                try:
-                    year = int(published_date.split('-')[0])
-                except (ValueError, IndexError):
-                    pass
+            # Дата приходит как "2004", "2004-05" или "2004-05-17"
+            year_part = volume_info.get('publishedDate', '').partition('-')[0]
+            year = int(year_part) if year_part.isascii() and year_part.isdigit() else None
             
             return {
                 'source': 'googlebooks',
@@ -250,7 +140,7 @@ class GoogleBooksSource(BookSource):
             }
             
         except Exception as e:
-            logger.error(f"Ошибка при форматировании данных Google Books: {e}")
+            logger.error("Ошибка при форматировании данных Google Books: %s", e)
             return None
 
 class LibraryOfCongressSource(BookSource):
@@ -258,7 +148,7 @@ class LibraryOfCongressSource(BookSource):
     
     def __init__(self):
         self.base_url = 'https://www.loc.gov/books'
-        self.session = requests.Session()
+        self.session = http_session
     
     def search_books(self, query: str, limit: int = 5) -> List[Dict]:
         """Поиск книг в Library of Congress"""
@@ -282,7 +172,7 @@ class LibraryOfCongressSource(BookSource):
             return books
             
         except Exception as e:
-            logger.error(f"Ошибка в Library of Congress: {e}")
+            logger.error("Ошибка в Library of Congress: %s", e)
             return []
     
     def get_source_name(self) -> str:
@@ -293,7 +183,7 @@ class ISBNDBSource(BookSource):
     
     def __init__(self):
         self.base_url = 'https://api2.isbndb.com'
-        self.session = requests.Session()
+        self.session = http_session
         # API ключ нужно будет запросить у пользователя
         self.api_key = None
     
@@ -314,7 +204,7 @@ class ISBNDBSource(BookSource):
                                       headers=headers, params=params, timeout=10)
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             books = []
             
             for book_data in data.get('books', [])[:limit]:
@@ -322,11 +212,11 @@ class ISBNDBSource(BookSource):
                 if book:
                     books.append(book)
             
-            logger.info(f"ISBNDB: найдено {len(books)} книг")
+            logger.info("ISBNDB: найдено %d книг", len(books))
             return books
             
         except Exception as e:
-            logger.error(f"Ошибка в ISBNDB: {e}")
+            logger.error("Ошибка в ISBNDB: %s", e)
             return []
     
     def get_source_name(self) -> str:
@@ -340,7 +230,7 @@ class ISBNDBSource(BookSource):
                 return None
             
             authors = book_data.get('authors', [])
-            author = ', '.join(authors) if authors else 'Неизвестный автор'
+            author = join_authors(authors)
             
             return {
                 'source': 'isbndb',
@@ -355,55 +245,119 @@ class ISBNDBSource(BookSource):
             }
             
         except Exception as e:
-            logger.error(f"Ошибка при форматировании данных ISBNDB: {e}")
+            logger.error("Ошибка при форматировании данных ISBNDB: %s", e)
             return None
 
 class BookSourceManager:
     """Менеджер источников книг"""
     
     def __init__(self):
-        self.sources = {
-            'openlibrary': OpenLibrarySource(),
-            'googlebooks': GoogleBooksSource(),
-            'loc': LibraryOfCongressSource(),
-            'isbndb': ISBNDBSource()
+        # Классы источников; клиент создается при первом обращении, чтобы неиспользуемые
+        # источники не держали HTTP-сессии и пулы соединений
+        self._source_factories = {
+            'openlibrary': OpenLibrarySource,
+            'googlebooks': GoogleBooksSource,
+            'loc': LibraryOfCongressSource,
+            'isbndb': ISBNDBSource
         }
+        self._sources: Dict[str, BookSource] = {}
         self.active_sources = ['openlibrary', 'googlebooks']  # Активные по умолчанию
+        # Недавние результаты поиска: {(source_id, запрос, limit): [книги]}
+        self._search_cache = TTLCache(maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL)
+        # Выполняющиеся поиски, к которым присоединяются одинаковые запросы
+        self._pending_searches: Dict[tuple, asyncio.Task] = {}
+    
+    def _get_source(self, source_id: str) -> BookSource:
+        """Клиент источника, создаваемый при первом обращении"""
+        source = self._sources.get(source_id)
+        if source is None:
+            source = self._source_factories[source_id]()
+            self._sources[source_id] = source
+        return source
     
     def get_available_sources(self) -> List[Dict]:
         """Получить список доступных источников"""
         return [
             {
                 'id': source_id,
-                'name': source.get_source_name(),
+                'name': self._get_source(source_id).get_source_name(),
                 'active': source_id in self.active_sources
             }
-            for source_id, source in self.sources.items()
+            for source_id in self._source_factories
         ]
     
-    def search_in_source(self, source_id: str, query: str, limit: int = 5) -> List[Dict]:
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        """Запрос в виде ключа кэша: регистр, пробелы по краям и кавычки на поиск не влияют"""
+        return query.strip().lower().translate(QUOTES_TABLE)
+    
+    async def search_in_source(self, source_id: str, query: str, limit: int = 5) -> List[Dict]:
         """Поиск в конкретном источнике"""
-        if source_id not in self.sources:
+        if source_id not in self._source_factories:
             return []
         
-        return self.sources[source_id].search_books(query, limit)
+        key = (source_id, self._normalize_query(query), limit)
+        books = self._search_cache.get(key)
+        if books is not None:
+            # Копия списка: вызывающий код может менять его, не портя кэш
+            return list(books)
+        
+        # Одновременные одинаковые запросы ждут один и тот же поиск
+        task = self._pending_searches.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._search_and_cache(key, source_id, query, limit))
+            self._pending_searches[key] = task
+            task.add_done_callback(lambda _: self._pending_searches.pop(key, None))
+        
+        # shield: отмена одного ожидающего не прерывает поиск для остальных
+        return list(await asyncio.shield(task))
+    
+    async def _search_and_cache(self, key: tuple, source_id: str, query: str, limit: int) -> List[Dict]:
+        """Поиск в источнике с сохранением результата в кэш"""
+        # Запросы к API блокирующие, поэтому выполняем их в отдельном потоке
+        books = await asyncio.to_thread(self._get_source(source_id).search_books, query, limit)
+        
+        # Пустой результат может означать сбой источника, поэтому храним его недолго
+        self._search_cache.set(key, books, ttl=None if books else SEARCH_EMPTY_CACHE_TTL)
+        return books
     
-    def search_in_all_sources(self, query: str, limit_per_source: int = 3) -> Dict[str, List[Dict]]:
+    async def search_in_all_sources(self, query: str, limit_per_source: int = 3) -> Dict[str, List[Dict]]:
         """Поиск во всех активных источниках"""
-        results = {}
+        source_ids = [source_id for source_id in self.active_sources if source_id in self._source_factories]
         
-        for source_id in self.active_sources:
-            if source_id in self.sources:
-                try:
-                    books = self.sources[source_id].search_books(query, limit_per_source)
-                    if books:
-                        results[source_id] = books
-                        logger.info(f"Источник {source_id}: найдено {len(books)} книг")
-                except Exception as e:
-                    logger.error(f"Ошибка в источнике {source_id}: {e}")
-                    continue
+        # Опрашиваем источники параллельно: общее время равно самому медленному запросу
+        all_books = await asyncio.gather(
+            *(self.search_in_source(source_id, query, limit_per_source) for source_id in source_ids),
+            return_exceptions=True
+        )
+        
+        results = {}
+        for source_id, books in zip(source_ids, all_books):
+            if isinstance(books, Exception):
+                logger.error("Ошибка в источнике %s: %s", source_id, books)
+                continue
+            if books:
+                results[source_id] = books
+                logger.info("Источник %s: найдено %d книг", source_id, len(books))
         
         return results
 
+    @staticmethod
+    def merge_results(results: Dict[str, List[Dict]]) -> List[Dict]:
+        """Объединение результатов источников в один список без повторов одной книги.
+
+        Книга считается повтором, если совпадают название и первый автор без учета регистра;
+        остается первое вхождение в порядке источников.
+        """
+        unique_books = {}
+        for books in results.values():
+            for book in books:
+                key = (
+                    (book.get('title') or '').lower(),
+                    (book.get('author') or '').split(',')[0].strip().lower()
+                )
+                unique_books.setdefault(key, book)
+        return list(unique_books.values())
+
 # Создаем глобальный экземпляр менеджера
 book_source_manager = BookSourceManager()
\ No newline at end of file
@@ -4,87 +4,162 @@
 Модуль интеграции с Open Library API
 """
 
+import functools
 import requests
 import logging
-from typing import List, Dict, Optional
+import orjson
+import re
+from types import MappingProxyType
+from typing import List, Dict, Optional, Tuple
 from config import (
     OPENLIBRARY_SEARCH_URL, OPENLIBRARY_WORKS_URL, 
     OPENLIBRARY_COVERS_URL, SEARCH_RESULTS_PER_PAGE
 )
+from utils.formatting import join_authors
+from utils.http import http_session
 
 logger = logging.getLogger(__name__)
 
+# Переводы жанров Open Library; ключи в нижнем регистре для сравнения с темами книг
+GENRE_TRANSLATIONS = MappingProxyType({
+    'fiction': 'Художественная литература',
+    'science fiction': 'Научная фантастика',
+    'fantasy': 'Фэнтези',
+    'mystery': 'Детектив',
+    'romance': 'Роман',
+    'thriller': 'Триллер',
+    'horror': 'Ужасы',
+    'biography': 'Биография',
+    'history': 'История',
+    'philosophy': 'Философия',
+    'poetry': 'Поэзия',
+    'drama': 'Драма',
+    'adventure': 'Приключения',
+    'classic literature': 'Классическая литература',
+    'young adult': 'Молодежная литература',
+    'children': 'Детская литература',
+    'non-fiction': 'Документальная литература',
+    'self-help': 'Саморазвитие',
+    'science': 'Наука',
+    'technology': 'Технологии'
+})
+
+# Приоритетные жанры в порядке проверки
+PRIORITY_GENRES = tuple(GENRE_TRANSLATIONS)
+GENRE_PRIORITY = MappingProxyType({genre: priority for priority, genre in enumerate(PRIORITY_GENRES)})
+
+# Все жанры одним выражением: темы просматриваются за один проход вместо поиска
+# каждого жанра отдельно. Опережающая проверка находит и перекрывающиеся вхождения
+# ("fiction" внутри "science fiction")
+GENRE_PATTERN = re.compile('(?=(' + '|'.join(map(re.escape, PRIORITY_GENRES)) + '))')
+
+# Шаблон URL обложки среднего размера для результатов поиска
+MEDIUM_COVER_URL = f'{OPENLIBRARY_COVERS_URL}/%s-M.jpg'
+
+# Таблица для удаления кавычек из запроса за один проход str.translate
+QUOTES_TABLE = str.maketrans('', '', '"\'')
+
+# Символы синтаксиса Lucene, которые в тексте пользователя экранируются обратной косой чертой
+LUCENE_SPECIAL_PATTERN = re.compile(r'([+\-!(){}\[\]^"~*?:\\/&|])')
+# Операторы Lucene распознаются только в верхнем регистре, строчные слова ищутся как обычные
+LUCENE_OPERATORS = frozenset(('AND', 'OR', 'NOT'))
+
+def _escape_lucene(text: str) -> str:
+    """Текст пользователя как обычные слова запроса Lucene, без операторов и полей"""
+    words = [word.lower() if word in LUCENE_OPERATORS else word for word in text.split()]
+    return LUCENE_SPECIAL_PATTERN.sub(r'\\\1', ' '.join(words))
+
+# Функции ниже зависят только от аргументов, поэтому результаты кэшируются:
+# популярные запросы и повторяющиеся наборы тем книг не разбираются заново
+
+@functools.lru_cache(maxsize=1024)
+def _format_search_query(query: str) -> str:
+    """Форматирование поискового запроса для лучших результатов"""
+    query = query.strip()
+    
+    # Убираем лишние символы
+    query = query.translate(QUOTES_TABLE)
+    
+    # Если запрос короткий (вероятно фамилия автора), форматируем для поиска автора
+    if len(query.split()) == 1 and len(query) > 2:
+        return f'author:{_escape_lucene(query)}'
+    
+    return _escape_lucene(query)
+
+@functools.lru_cache(maxsize=1024)
+def _build_search_query(query: str) -> str:
+    """Один запрос со всеми вариантами поиска через OR: свободный текст, автор, название.
+
+    Пустая строка означает, что после удаления кавычек искать нечего.
+    """
+    cleaned = ' '.join(query.translate(QUOTES_TABLE).split())
+    if not cleaned:
+        return ''
+    
+    # Внутри фразы в кавычках особое значение сохраняет только обратная косая черта
+    phrase = cleaned.replace('\\', '\\\\')
+    return f'({_format_search_query(query)}) OR author:"{phrase}" OR title:"{phrase}"'
+
+@functools.lru_cache(maxsize=4096)
+def _extract_main_genre(subjects: Tuple[str, ...]) -> str:
+    """Извлечение основного жанра из списка тем"""
+    if not subjects:
+        return 'Не указан'
+    
+    # Ищем приоритетные жанры во всех темах сразу; перевод строки не дает
+    # жанру совпасть на стыке двух тем
+    found = set(GENRE_PATTERN.findall('\n'.join(subjects).lower()))
+    if found:
+        return GENRE_TRANSLATIONS[min(found, key=GENRE_PRIORITY.__getitem__)]
+    
+    # Если не найден приоритетный жанр, берем первый
+    return _translate_genre(subjects[0])
+
+@functools.lru_cache(maxsize=1024)
+def _translate_genre(genre: str) -> str:
+    """Перевод жанра на русский язык"""
+    return GENRE_TRANSLATIONS.get(genre.lower(), genre)
+
 class OpenLibraryAPI:
     """Класс для работы с Open Library API"""
     
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'BookBot/1.0 (Contact: your-email@example.com)'
-        })
+        self.session = http_session
     
     def search_books(self, query: str, limit: int = SEARCH_RESULTS_PER_PAGE) -> List[Dict]:
         """Поиск книг по названию или автору"""
         try:
-            # Улучшаем поисковый запрос
-            formatted_query = self._format_search_query(query)
+            search_query = _build_search_query(query)
+            if not search_query:
+                return []
             
             params = {
-                'q': formatted_query,
+                'q': search_query,
                 'limit': limit,
                 'fields': 'key,title,author_name,first_publish_year,subject,cover_i,edition_count'
             }
             
-            # Делаем несколько попыток с разными форматами запроса
-            search_attempts = [
-                formatted_query,
-                f'author:"{query}"',  # Поиск по автору
-                f'title:"{query}"',   # Поиск по названию
-                query.replace(' ', '+')  # Замена пробелов на +
-            ]
+            response = self.session.get(OPENLIBRARY_SEARCH_URL, params=params, timeout=10)
+            response.raise_for_status()
             
-            for attempt_query in search_attempts:
-                try:
-                    params['q'] = attempt_query
-                    response = self.session.get(OPENLIBRARY_SEARCH_URL, params=params, timeout=15)
-                    response.raise_for_status()
-                    
-                    data = response.json()
-                    books = []
-                    
-                    for doc in data.get('docs', []):
-                        book = self._format_book_data(doc)
-                        if book:
-                            books.append(book)
-                    
-                    if books:  # Если нашли результаты, возвращаем их
-                        logger.info(f"Найдено {len(books)} книг по запросу: {attempt_query}")
-                        return books
-                        
-                except requests.RequestException as e:
-                    logger.warning(f"Попытка поиска с запросом '{attempt_query}' неудачна: {e}")
-                    continue
+            data = orjson.loads(response.content)
+            books = []
             
-            logger.warning(f"Все попытки поиска для '{query}' неудачны")
-            return []
+            for doc in data.get('docs', [])[:limit]:
+                book = self._format_book_data(doc)
+                if book:
+                    books.append(book)
+            
+            logger.info("Найдено %d книг по запросу: %s", len(books), query)
+            return books
             
+        except requests.RequestException as e:
+            logger.warning("Поиск по запросу '%s' неудачен: %s", query, e)
+            return []
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при поиске книг: {e}")
+            logger.error("Неожиданная ошибка при поиске книг: %s", e)
             return []
     
-    def _format_search_query(self, query: str) -> str:
-        """Форматирование поискового запроса для лучших результатов"""
-        query = query.strip()
-        
-        # Убираем лишние символы
-        query = query.replace('"', '').replace("'", "")
-        
-        # Если запрос короткий (вероятно фамилия автора), форматируем для поиска автора
-        if len(query.split()) == 1 and len(query) > 2:
-            return f'author:{query}'
-        
-        return query
-    
     def get_book_details(self, work_key: str) -> Optional[Dict]:
         """Получение подробной информации о книге по work key"""
         try:
@@ -96,7 +171,7 @@ class OpenLibraryAPI:
             response = self.session.get(url, timeout=10)
             response.raise_for_status()
             
-            data = response.json()
+            data = orjson.loads(response.content)
             
             return {
                 'key': data.get('key', ''),
@@ -108,10 +183,10 @@ class OpenLibraryAPI:
             }
             
         except requests.RequestException as e:
-            logger.error(f"Ошибка при получении деталей книги {work_key}: {e}")
+            logger.error("Ошибка при получении деталей книги %s: %s", work_key, e)
             return None
         except Exception as e:
-            logger.error(f"Неожиданная ошибка при получении деталей книги: {e}")
+            logger.error("Неожиданная ошибка при получении деталей книги: %s", e)
             return None
     
     def get_cover_url(self, cover_id: int, size: str = 'M') -> str:
@@ -128,20 +203,23 @@ class OpenLibraryAPI:
                 return None
             
             authors = doc.get('author_name', [])
-            author = ', '.join(authors) if authors else 'Неизвестный автор'
+            author = join_authors(authors)
             
             # Извлекаем жанр из subjects
             subjects = doc.get('subject', [])
-            genre = self._extract_main_genre(subjects)
+            genre = _extract_main_genre(tuple(subjects))
             
             # URL обложки
-            cover_url = None
             cover_id = doc.get('cover_i')
-            if cover_id:
-                cover_url = self.get_cover_url(cover_id)
+            cover_url = MEDIUM_COVER_URL % cover_id if cover_id else None
             
+            key = doc.get('key', '')
             return {
-                'openlibrary_key': doc.get('key', ''),
+                # Поля общего формата источников книг (services.book_sources)
+                'source': 'openlibrary',
+                'external_id': key,
+                'description': '',  # Open Library не всегда предоставляет описание в поиске
+                'openlibrary_key': key,
                 'title': title,
                 'author': author,
                 'genre': genre,
@@ -152,7 +230,7 @@ class OpenLibraryAPI:
             }
             
         except Exception as e:
-            logger.error(f"Ошибка при форматировании данных книги: {e}")
+            logger.error("Ошибка при форматировании данных книги: %s", e)
             return None
     
     def _extract_description(self, description_field) -> str:
@@ -173,57 +251,5 @@ class OpenLibraryAPI:
         
         return ''
     
-    def _extract_main_genre(self, subjects: List[str]) -> str:
-        """Извлечение основного жанра из списка тем"""
-        if not subjects:
-            return 'Не указан'
-        
-        # Приоритетные жанры на английском
-        priority_genres = [
-            'Fiction', 'Science Fiction', 'Fantasy', 'Mystery', 'Romance',
-            'Thriller', 'Horror', 'Biography', 'History', 'Philosophy',
-            'Poetry', 'Drama', 'Adventure', 'Classic Literature', 'Young Adult',
-            'Children', 'Non-fiction', 'Self-help', 'Science', 'Technology'
-        ]
-        
-        # Ищем приоритетные жанры
-        for genre in priority_genres:
-            for subject in subjects:
-                if genre.lower() in subject.lower():
-                    return self._translate_genre(genre)
-        
-        # Если не найден приоритетный жанр, берем первый
-        if subjects:
-            return self._translate_genre(subjects[0])
-        
-        return 'Не указан'
-    
-    def _translate_genre(self, genre: str) -> str:
-        """Перевод жанра на русский язык"""
-        translations = {
-            'Fiction': 'Художественная литература',
-            'Science Fiction': 'Научная фантастика',
-            'Fantasy': 'Фэнтези',
-            'Mystery': 'Детектив',
-            'Romance': 'Роман',
-            'Thriller': 'Триллер',
-            'Horror': 'Ужасы',
-            'Biography': 'Биография',
-            'History': 'История',
-            'Philosophy': 'Философия',
-            'Poetry': 'Поэзия',
-            'Drama': 'Драма',
-            'Adventure': 'Приключения',
-            'Classic Literature': 'Классическая литература',
-            'Young Adult': 'Молодежная литература',
-            'Children': 'Детская литература',
-            'Non-fiction': 'Документальная литература',
-            'Self-help': 'Саморазвитие',
-            'Science': 'Наука',
-            'Technology': 'Технологии'
-        }
-        
-        return translations.get(genre, genre)
-
 # Создаем глобальный экземпляр API
 openlibrary_api = OpenLibraryAPI()
@@ -4,63 +4,271 @@
 Модуль рекомендательной системы
 """
 
+import asyncio
+import functools
 import logging
-from typing import List, Dict, Optional
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, List, Dict, Optional, Set, Tuple
+import joblib
 import numpy as np
+from database import async_db
 from database.db import (
-    get_user_books, get_user_genres_and_ratings, 
+    iter_user_books, get_user_genres_and_ratings, 
     search_books_in_db, get_connection
 )
 from services.openlibrary import openlibrary_api
-from config import MAX_RECOMMENDATIONS
+from config import (
+    MAX_RECOMMENDATIONS, RECOMMENDATIONS_CORPUS_TTL, RECOMMENDATIONS_CORPUS_PATH,
+    RECOMMENDATIONS_MAX_WORKERS
+)
+from utils.cache import TTLCache
+
+if TYPE_CHECKING:
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
 
 logger = logging.getLogger(__name__)
 
+# Поля книги, которые возвращают все запросы рекомендательной системы
+BOOK_COLUMNS = 'id, title, author, genre, description, cover_url, publication_year'
+BOOK_FIELDS = tuple(BOOK_COLUMNS.split(', '))
+
+# Жанров, по которым подбираются рекомендации
+MAX_PREFERRED_GENRES = 3
+
+GENRE_BOOKS_SUBQUERY = f'''
+    SELECT * FROM (
+        SELECT {BOOK_COLUMNS}
+        FROM books 
+        WHERE genre LIKE ?
+        ORDER BY RANDOM()
+        LIMIT ?
+    )
+'''
+# Книги по нескольким жанрам одним запросом: подзапросы с собственным лимитом через UNION ALL
+GENRE_BOOKS_QUERIES = {
+    count: ' UNION ALL '.join([GENRE_BOOKS_SUBQUERY] * count)
+    for count in range(1, MAX_PREFERRED_GENRES + 1)
+}
+# Кандидаты выбираются случайной выборкой из ID книг с описанием (их читает частичный
+# индекс idx_books_with_description), а затем читаются по первичному ключу, без сортировки таблицы
+DESCRIBED_BOOK_IDS_QUERY = "SELECT id FROM books WHERE description IS NOT NULL AND description != ''"
+CANDIDATE_BOOKS_QUERY = f'''
+    SELECT {BOOK_COLUMNS}
+    FROM books 
+    WHERE id IN ({{placeholders}})
+'''
+# Изменение числа книг или появление новой делает сохраненный на диск корпус устаревшим
+CORPUS_FINGERPRINT_QUERY = 'SELECT COUNT(*), MAX(id) FROM books'
+# Версия формата сохраненного корпуса: файлы другой версии игнорируются
+CORPUS_FORMAT_VERSION = 2
+POPULAR_BOOKS_QUERY = f'''
+    SELECT {', '.join('b.' + column for column in BOOK_COLUMNS.split(', '))},
+           COUNT(ub.book_id) as popularity
+    FROM books b
+    LEFT JOIN user_books ub ON b.id = ub.book_id
+    GROUP BY b.id
+    ORDER BY popularity DESC, b.id DESC
+    LIMIT ?
+'''
+
+# Поля книги, из которых складывается текст для TF-IDF; в BOOK_FIELDS они идут сразу после id
+TEXT_FIELDS = ('title', 'author', 'genre', 'description')
+
+def _book_text(title: Optional[str], author: Optional[str], genre: Optional[str],
+               description: Optional[str]) -> str:
+    """Текст книги для TF-IDF: непустые название, автор, жанр и начало описания"""
+    return ' '.join(filter(None, (title, author, genre, description and description[:500])))
+
+def _make_book_factory(recommendation_type: str):
+    """Фабрика строк курсора: словарь книги с уже проставленным типом рекомендации"""
+    def factory(cursor, row):
+        book = {column[0]: value for column, value in zip(cursor.description, row)}
+        book['recommendation_type'] = recommendation_type
+        return book
+    return factory
+
+# Пул потоков для TF-IDF: расчет занимает процессор, а не базу, поэтому не выполняется
+# в пуле потоков БД. Каждому потоку нужно соединение из пула для чтения кандидатов
+_scoring_executor = ThreadPoolExecutor(max_workers=RECOMMENDATIONS_MAX_WORKERS,
+                                       thread_name_prefix='recommendations')
+
 class RecommendationSystem:
     """Система рекомендаций книг"""
     
     def __init__(self):
-        self.tfidf_vectorizer = TfidfVectorizer(
+        # Обученный на кандидатах IDF, сами кандидаты и их TF-IDF матрица: IDF считается
+        # один раз на корпус кандидатов, а на запрос выполняется только transform()
+        self._corpus_cache = TTLCache(maxsize=1, ttl=RECOMMENDATIONS_CORPUS_TTL)
+        # Корпус перестраивает и сохраняет один поток, остальные дожидаются его результата
+        self._corpus_lock = threading.Lock()
+    
+    @functools.cached_property
+    def hashing_vectorizer(self) -> 'HashingVectorizer':
+        """Векторизатор текстов книг, создаваемый при первом расчете рекомендаций"""
+        # scikit-learn импортируется здесь, а не при загрузке модуля, чтобы не замедлять запуск бота
+        from sklearn.feature_extraction.text import HashingVectorizer
+        
+        # Хэширование признаков не требует словаря: тексты пользователя и кандидатов
+        # попадают в одно пространство без обучения, в том числе незнакомые слова
+        return HashingVectorizer(
             stop_words='english',
-            max_features=5000,
-            ngram_range=(1, 2)
+            n_features=2 ** 18,
+            ngram_range=(1, 2),
+            alternate_sign=False,
+            norm=None,
+            # Одинарной точности достаточно для сравнения схожести с порогом 0.05,
+            # а матрицы TF-IDF и произведение с ними вдвое меньше по памяти
+            dtype=np.float32
+        )
+    
+    def _warm_cache(self) -> Optional[Tuple['TfidfTransformer', List[Tuple], Any]]:
+        """Расчет IDF по корпусу кандидатов и сохранение результата в кэш"""
+        corpus = self._corpus_cache.get('corpus')
+        if corpus is not None:
+            return corpus
+        
+        with self._corpus_lock:
+            # Пока поток ждал блокировку, корпус мог построить другой поток
+            corpus = self._corpus_cache.get('corpus')
+            if corpus is not None:
+                return corpus
+            return self._build_corpus()
+    
+    def _build_corpus(self) -> Optional[Tuple['TfidfTransformer', List[Tuple], Any]]:
+        """Чтение корпуса с диска или его расчет заново; вызывается под _corpus_lock"""
+        # После перезапуска процесса корпус берется с диска, если база с тех пор не менялась
+        fingerprint = self._corpus_fingerprint()
+        corpus = self._load_corpus(fingerprint)
+        if corpus is not None:
+            self._corpus_cache.set('corpus', corpus)
+            return corpus
+        
+        candidate_rows = self._get_candidate_rows()
+        if not candidate_rows:
+            return None
+        
+        candidate_texts = [_book_text(*row[1:len(TEXT_FIELDS) + 1]) for row in candidate_rows]
+        
+        from sklearn.feature_extraction.text import TfidfTransformer
+        
+        tfidf_transformer = TfidfTransformer()
+        candidate_matrix = tfidf_transformer.fit_transform(
+            self.hashing_vectorizer.transform(candidate_texts)
         )
+        
+        corpus = (tfidf_transformer, candidate_rows, candidate_matrix)
+        self._corpus_cache.set('corpus', corpus)
+        self._save_corpus(corpus, fingerprint)
+        return corpus
+    
+    def _corpus_fingerprint(self) -> Optional[Tuple[int, int]]:
+        """Число книг в базе и наибольший ID книги"""
+        try:
+            with get_connection() as conn:
+                return tuple(conn.execute(CORPUS_FINGERPRINT_QUERY).fetchone())
+        except Exception as e:
+            logger.error(f"Ошибка при проверке состояния базы книг: {e}")
+            return None
     
-    def get_recommendations(self, user_id: int) -> List[Dict]:
+    def _load_corpus(self, fingerprint: Optional[Tuple[int, int]]) -> Optional[Tuple['TfidfTransformer', List[Tuple], Any]]:
+        """Чтение сохраненного корпуса, если он построен по той же базе и не устарел"""
+        if fingerprint is None:
+            return None
+        try:
+            saved = joblib.load(RECOMMENDATIONS_CORPUS_PATH)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning("Не удалось прочитать сохраненный корпус рекомендаций", exc_info=True)
+            return None
+        
+        if saved.get('version') != CORPUS_FORMAT_VERSION or saved.get('fingerprint') != fingerprint:
+            return None
+        if saved.get('saved_at', 0) + RECOMMENDATIONS_CORPUS_TTL <= time.time():
+            return None
+        return saved['transformer'], saved['rows'], saved['matrix']
+    
+    def _save_corpus(self, corpus: Tuple['TfidfTransformer', List[Tuple], Any], fingerprint: Optional[Tuple[int, int]]):
+        """Сохранение корпуса на диск для следующего запуска"""
+        if fingerprint is None:
+            return
+        tfidf_transformer, candidate_rows, candidate_matrix = corpus
+        # Корпус пишется во временный файл рядом с целевым и подменяет его одним os.replace,
+        # поэтому при сбое записи на диске не остается наполовину записанного файла
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(RECOMMENDATIONS_CORPUS_PATH),
+                prefix=os.path.basename(RECOMMENDATIONS_CORPUS_PATH) + '.',
+                suffix='.tmp'
+            )
+            os.close(fd)
+            joblib.dump({
+                'version': CORPUS_FORMAT_VERSION,
+                'fingerprint': fingerprint,
+                'saved_at': time.time(),
+                'transformer': tfidf_transformer,
+                'rows': candidate_rows,
+                'matrix': candidate_matrix,
+            }, tmp_path, compress=3)
+            os.replace(tmp_path, RECOMMENDATIONS_CORPUS_PATH)
+        except Exception:
+            logger.warning("Не удалось сохранить корпус рекомендаций", exc_info=True)
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+    
+    async def get_recommendations(self, user_id: int) -> List[Dict]:
         """Получение персональных рекомендаций для пользователя"""
+        # Запросы к базе выполняются в пуле потоков БД, а векторизация и расчет схожести
+        # в собственном пуле, чтобы долгий расчет не задерживал короткие запросы к базе
         try:
-            user_books = get_user_books(user_id)
+            user_books = await async_db.get_user_books(user_id)
             if len(user_books) <= 2:
-                return self._get_popular_books()
-            
-            # Комбинируем разные подходы к рекомендациям
-            genre_recs = self._get_genre_based_recommendations(user_id)
-            content_recs = self._get_content_based_recommendations(user_id)
+                return await async_db.run_in_db_thread(self._get_popular_books)
             
-            import random
-            all_recommendations = genre_recs + content_recs
-            unique_recs = self._remove_duplicates(all_recommendations)
+            # Комбинируем разные подходы к рекомендациям; они независимы и считаются одновременно
+            loop = asyncio.get_running_loop()
+            genre_recs, content_recs = await asyncio.gather(
+                async_db.run_in_db_thread(self._get_genre_based_recommendations, user_id),
+                loop.run_in_executor(
+                    _scoring_executor,
+                    functools.partial(self._get_content_based_recommendations, user_id, user_books)
+                )
+            )
+            return await async_db.run_in_db_thread(
+                self._combine_recommendations, user_books, genre_recs, content_recs
+            )
             
+        except Exception as e:
+            logger.error(f"Ошибка при генерации рекомендаций для пользователя {user_id}: {e}")
+            return await async_db.run_in_db_thread(self._get_popular_books)
+    
+    def _combine_recommendations(self, user_books: List[Dict], genre_recs: List[Dict],
+                                 content_recs: List[Dict]) -> List[Dict]:
+        """Объединение рекомендаций без книг пользователя, с фоллбэком на популярные"""
+        try:
             user_book_ids = {b['id'] for b in user_books}
-            # Фильтруем персональные рекомендации
-
-            personal_recs = [b for b in unique_recs if b['id'] not in user_book_ids]
-            # Рандомизируем порядок
-            random.shuffle(personal_recs)
-
+            # Убираем дубликаты и книги пользователя за один проход
+            personal_recs = self._remove_duplicates(genre_recs + content_recs, exclude_ids=user_book_ids)
+            # Случайная выборка в случайном порядке: перемешиваются только попавшие в нее книги
             if personal_recs:
-                return personal_recs[:MAX_RECOMMENDATIONS]
+                return random.sample(personal_recs, min(MAX_RECOMMENDATIONS, len(personal_recs)))
             # Иначе — переходим к фоллбэку популярных
             popular = self._get_popular_books()
             # Фильтруем популярных от того же
             popular = [b for b in popular if b['id'] not in user_book_ids]
-            random.shuffle(popular)
-            return popular[:MAX_RECOMMENDATIONS]
+            return random.sample(popular, min(MAX_RECOMMENDATIONS, len(popular)))
             
         except Exception as e:
-            logger.error(f"Ошибка при генерации рекомендаций для пользователя {user_id}: {e}")
+            logger.error(f"Ошибка при объединении рекомендаций: {e}")
             return self._get_popular_books()
     
     def _get_genre_based_recommendations(self, user_id: int) -> List[Dict]:
@@ -80,162 +288,106 @@ class RecommendationSystem:
                 # Если нет высоких оценок, берем топ-3 жанра
                 preferred_genres = [genre for genre, _, _ in user_genres[:3]]
             
-            recommendations = []
-            for genre in preferred_genres[:3]:  # Ограничиваем количество жанров
-                genre_books = self._find_books_by_genre(genre, limit=5)
-                recommendations.extend(genre_books)
-            
-            return recommendations
+            # Ограничиваем количество жанров
+            return self._find_books_by_genres(preferred_genres[:MAX_PREFERRED_GENRES], limit=5)
             
         except Exception as e:
             logger.error(f"Ошибка при поиске рекомендаций по жанрам: {e}")
             return []
     
-    def _get_content_based_recommendations(self, user_id: int) -> List[Dict]:
-        """Рекомендации на основе содержания книг (TF-IDF)"""
+    def _get_content_based_recommendations(self, user_id: int,
+                                           user_books: Optional[List[Dict]] = None) -> List[Dict]:
+        """Рекомендации на основе содержания книг (TF-IDF).
+
+        Уже загруженные книги пользователя передаются в user_books, чтобы не читать их повторно.
+        """
         try:
-            user_books = get_user_books(user_id)
+            if user_books is None:
+                # В память попадают только высоко оцененные книги, остальные отбрасываются при чтении
+                user_books = iter_user_books(user_id)
             high_rated_books = [
-                book for book in user_books 
-                if book.get('user_rating', 0) >= 5
+                book for book in user_books
+                if (book.get('user_rating') or 0) >= 5
             ]
             
             if not high_rated_books:
                 return []
             
             # Подготавливаем тексты для анализа
-            user_texts = []
-            for book in high_rated_books:
-                text_parts = []
-                if book.get('title'):
-                    text_parts.append(book['title'])
-                if book.get('author'):
-                    text_parts.append(book['author'])
-                if book.get('genre'):
-                    text_parts.append(book['genre'])
-                if book.get('description'):
-                    text_parts.append(book['description'][:500])  # Ограничиваем длину
-                
-                user_texts.append(' '.join(text_parts))
+            user_texts = [_book_text(*map(book.get, TEXT_FIELDS)) for book in high_rated_books]
             
-            if not user_texts:
+            # Кандидаты и рассчитанный по ним IDF берутся из кэша
+            corpus = self._warm_cache()
+            if corpus is None:
                 return []
+            tfidf_transformer, candidate_rows, candidate_matrix = corpus
             
-            # Получаем кандидатов для рекомендаций
-            candidate_books = self._get_candidate_books()
-            if not candidate_books:
-                return []
+            user_matrix = tfidf_transformer.transform(self.hashing_vectorizer.transform(user_texts))
             
-            candidate_texts = []
-            for book in candidate_books:
-                text_parts = []
-                if book.get('title'):
-                    text_parts.append(book['title'])
-                if book.get('author'):
-                    text_parts.append(book['author'])
-                if book.get('genre'):
-                    text_parts.append(book['genre'])
-                if book.get('description'):
-                    text_parts.append(book['description'][:500])
-                
-                candidate_texts.append(' '.join(text_parts))
+            # Строки TF-IDF нормированы по L2, поэтому средняя косинусная схожесть кандидата
+            # с книгами пользователя равна скалярному произведению со средним вектором этих книг
+            user_mean = np.asarray(user_matrix.mean(axis=0)).ravel()
+            avg_similarities = candidate_matrix @ user_mean
             
-            # Вычисляем TF-IDF и схожесть
-            all_texts = user_texts + candidate_texts
-            
-            if len(all_texts) < 2:
-                return []
-            
-            try:
-                tfidf_matrix = self.tfidf_vectorizer.fit_transform(all_texts)
-            except ValueError:
-                # Если не удается построить TF-IDF (например, все тексты пустые)
+            # Порог схожести применяется ко всему вектору сразу, до отбора лучших
+            passed_indices = np.flatnonzero(avg_similarities > 0.05)
+            if not passed_indices.size:
                 return []
+            passed_scores = avg_similarities[passed_indices]
             
-            user_matrix = tfidf_matrix[:len(user_texts)]
-            candidate_matrix = tfidf_matrix[len(user_texts):]
-            
-            # Вычисляем среднюю схожесть с пользовательскими книгами
-            similarities = cosine_similarity(candidate_matrix, user_matrix)
-            avg_similarities = np.mean(similarities, axis=1)
+            # Отбираем топ-10 похожих книг частичным разбиением и сортируем только их
+            top_k = min(10, passed_indices.size)
+            top_positions = np.argpartition(-passed_scores, top_k - 1)[:top_k]
+            top_positions = top_positions[np.argsort(-passed_scores[top_positions])]
             
-            # Сортируем кандидатов по схожести
-            sorted_indices = np.argsort(avg_similarities)[::-1]
-            
-            recommendations = []
-            for idx in sorted_indices[:10]:  # Топ-10 похожих книг
-                if avg_similarities[idx] > 0.05:  # Минимальный порог схожести
-                    book = candidate_books[idx].copy()
-                    book['similarity_score'] = float(avg_similarities[idx])
-                    recommendations.append(book)
-            
-            return recommendations
+            # Словари собираются только для возвращаемых книг, а не для всех кандидатов
+            return [
+                dict(zip(BOOK_FIELDS, candidate_rows[idx]),
+                     recommendation_type='content_based', similarity_score=score)
+                for idx, score in zip(passed_indices[top_positions].tolist(),
+                                      passed_scores[top_positions].tolist())
+            ]
             
         except Exception as e:
             logger.error(f"Ошибка при контент-анализе: {e}")
             return []
     
-    def _find_books_by_genre(self, genre: str, limit: int = 5) -> List[Dict]:
-        """Поиск книг по жанру в локальной базе"""
+    def _find_books_by_genres(self, genres: List[str], limit: int = 5) -> List[Dict]:
+        """Поиск книг по каждому из жанров в локальной базе за один запрос"""
         try:
+            params = []
+            for genre in genres:
+                params.extend((f'%{genre}%', limit))
+            
             with get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT id, title, author, genre, description, cover_url, publication_year
-                    FROM books 
-                    WHERE genre LIKE ?
-                    ORDER BY RANDOM()
-                    LIMIT ?
-                ''', (f'%{genre}%', limit))
-                
-                rows = cursor.fetchall()
-                books = []
-                for row in rows:
-                    books.append({
-                        'id': row[0],
-                        'title': row[1],
-                        'author': row[2],
-                        'genre': row[3],
-                        'description': row[4],
-                        'cover_url': row[5],
-                        'publication_year': row[6],
-                        'recommendation_type': 'genre_based'
-                    })
+                cursor.row_factory = _make_book_factory('genre_based')
+                cursor.execute(GENRE_BOOKS_QUERIES[len(genres)], params)
                 
-                return books
+                return cursor.fetchall()
                 
         except Exception as e:
-            logger.error(f"Ошибка при поиске книг по жанру {genre}: {e}")
+            logger.error(f"Ошибка при поиске книг по жанрам {genres}: {e}")
             return []
     
-    def _get_candidate_books(self, limit: int = 100) -> List[Dict]:
-        """Получение кандидатов для контент-анализа"""
+    def _get_candidate_rows(self, limit: int = 100) -> List[Tuple]:
+        """Получение кандидатов для контент-анализа кортежами с полями BOOK_FIELDS"""
         try:
             with get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT id, title, author, genre, description, cover_url, publication_year
-                    FROM books 
-                    WHERE description IS NOT NULL AND description != ''
-                    ORDER BY RANDOM()
-                    LIMIT ?
-                ''', (limit,))
-                
-                rows = cursor.fetchall()
-                books = []
-                for row in rows:
-                    books.append({
-                        'id': row[0],
-                        'title': row[1],
-                        'author': row[2],
-                        'genre': row[3],
-                        'description': row[4],
-                        'cover_url': row[5],
-                        'publication_year': row[6],
-                        'recommendation_type': 'content_based'
-                    })
+                cursor.row_factory = None
+                described_ids = [row[0] for row in cursor.execute(DESCRIBED_BOOK_IDS_QUERY)]
+                if not described_ids:
+                    return []
                 
-                return books
+                ids = random.sample(described_ids, min(limit, len(described_ids)))
+                placeholders = ', '.join('?' * len(ids))
+                cursor.execute(CANDIDATE_BOOKS_QUERY.format(placeholders=placeholders), ids)
+                candidate_rows = cursor.fetchall()
+            
+            # IN не сохраняет порядок выборки, поэтому кандидаты перемешиваются
+            random.shuffle(candidate_rows)
+            return candidate_rows
                 
         except Exception as e:
             logger.error(f"Ошибка при получении кандидатов: {e}")
@@ -246,48 +398,26 @@ class RecommendationSystem:
         try:
             with get_connection() as conn:
                 cursor = conn.cursor()
-                cursor.execute('''
-                    SELECT b.id, b.title, b.author, b.genre, b.description, 
-                           b.cover_url, b.publication_year, COUNT(ub.book_id) as popularity
-                    FROM books b
-                    LEFT JOIN user_books ub ON b.id = ub.book_id
-                    GROUP BY b.id
-                    ORDER BY popularity DESC, b.id DESC
-                    LIMIT ?
-                ''', (limit,))
-                
-                rows = cursor.fetchall()
-                books = []
-                for row in rows:
-                    books.append({
-                        'id': row[0],
-                        'title': row[1],
-                        'author': row[2],
-                        'genre': row[3],
-                        'description': row[4],
-                        'cover_url': row[5],
-                        'publication_year': row[6],
-                        'recommendation_type': 'popular'
-                    })
+                cursor.row_factory = _make_book_factory('popular')
+                cursor.execute(POPULAR_BOOKS_QUERY, (limit,))
                 
-                return books
+                return cursor.fetchall()
                 
         except Exception as e:
             logger.error(f"Ошибка при получении популярных книг: {e}")
             return []
     
-    def _remove_duplicates(self, books: List[Dict]) -> List[Dict]:
-        """Удаление дубликатов из списка книг"""
-        seen_ids = set()
-        unique_books = []
-        
+    def _remove_duplicates(self, books: List[Dict], exclude_ids: Optional[Set[int]] = None) -> List[Dict]:
+        """Удаление дубликатов из списка книг, а также книг с ID из exclude_ids"""
+        exclude_ids = exclude_ids or set()
+        # Словарь сохраняет порядок вставки, а setdefault оставляет первое вхождение книги
+        unique_books = {}
         for book in books:
             book_id = book.get('id')
-            if book_id and book_id not in seen_ids:
-                seen_ids.add(book_id)
-                unique_books.append(book)
+            if book_id and book_id not in exclude_ids:
+                unique_books.setdefault(book_id, book)
         
-        return unique_books
+        return list(unique_books.values())
 
 # Создаем глобальный экземпляр системы рекомендаций
 recommendation_system = RecommendationSystem()
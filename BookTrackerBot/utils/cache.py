@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Кэши в памяти процесса
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+class TTLCache:
+    """LRU-кэш с ограниченным временем жизни записей"""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        # Кэши используются и из цикла событий, и из рабочих потоков БД
+        self._lock = threading.Lock()
+    
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Получение значения, если запись есть и не устарела"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            
+            self._data.move_to_end(key)
+            return value
+    
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Сохранение значения; ttl переопределяет время жизни для этой записи"""
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            # Вытесняем давно не использовавшиеся записи
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    def __setitem__(self, key: Hashable, value: Any):
+        self.set(key, value)
+    
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Удаление записи"""
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+    
+    def clear(self):
+        """Очистка кэша"""
+        with self._lock:
+            self._data.clear()
+    
+    def __len__(self) -> int:
+        return len(self._data)
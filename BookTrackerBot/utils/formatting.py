@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Подготовка полей книги для отображения в сообщениях и кнопках
+"""
+
+from typing import Dict, List
+from telegram.helpers import escape_markdown
+
+def add_display_fields(book: Dict) -> Dict:
+    """Добавление в книгу экранированных для Markdown и укороченных для кнопок полей.
+
+    Поля считаются один раз при загрузке книги, а не при каждом показе;
+    экранирование не дает названиям со звездочками и подчеркиваниями ломать разметку.
+    """
+    title = book.get('title') or 'Без названия'
+    author = book.get('author') or 'Неизвестный'
+    genre = book.get('genre') or ''
+
+    # Сообщения отправляются с parse_mode='Markdown', то есть в разметке первой версии
+    book['title_md'] = escape_markdown(title, version=1)
+    book['author_md'] = escape_markdown(author, version=1)
+    book['genre_md'] = escape_markdown(genre, version=1)
+
+    # Подписи кнопок результатов поиска
+    book['title_short'] = title[:30]
+    book['author_short'] = author[:20]
+
+    # Описание для карточки книги; полное описание остается в 'description' для базы
+    description = book.get('description') or ''
+    book['description_short'] = description[:199] + '…' if len(description) > 200 else description
+    return book
+
+def join_authors(authors: List[str]) -> str:
+    """Авторы книги одной строкой; у большинства книг один автор, и для него join не нужен"""
+    if not authors:
+        return 'Неизвестный автор'
+    if len(authors) == 1:
+        return authors[0]
+    return ', '.join(authors)
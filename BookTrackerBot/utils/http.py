@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+HTTP-сессии для запросов к внешним API
+"""
+
+from typing import Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+from config import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_MAX_RETRIES, HTTP_RETRY_BACKOFF
+
+def create_session(headers: Optional[Dict[str, str]] = None) -> requests.Session:
+    """Сессия с пулом keep-alive соединений и повтором запросов при сбоях сервера.
+
+    Пул рассчитан на одновременные поиски многих пользователей: соединения и TLS
+    не устанавливаются заново на каждый запрос. Повторы выполняет urllib3 на уже открытом соединении.
+    """
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_RETRY_BACKOFF,
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=retry
+    )
+    
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+# Общая сессия всех источников книг: один набор пулов соединений и заголовков
+# вместо отдельной сессии на каждый источник
+http_session = create_session({
+    'User-Agent': 'BookBot/1.0 (Contact: your-email@example.com)'
+})
@@ -5,8 +5,21 @@
 """
 
 import re
+import string
 from typing import Optional
 
+# Шаблоны компилируются один раз при загрузке модуля
+# Буквы и цифры, которые считаются содержательными в поисковом запросе (как [a-zA-Zа-яА-Я0-9])
+ALNUM_CHARS = frozenset(
+    string.ascii_letters + string.digits
+    + ''.join(map(chr, range(ord('а'), ord('я') + 1)))
+    + ''.join(map(chr, range(ord('А'), ord('Я') + 1)))
+)
+# Ключи Open Library, например: /works/OL123456W
+OPENLIBRARY_KEY_PATTERN = re.compile(r'^(/works/)?OL\d+[MW]?$')
+NUMBER_PATTERN = re.compile(r'\d+')
+URL_PATTERN = re.compile(r'^https?://[^\s/$.?#].[^\s]*$')
+
 def validate_rating(text: str) -> Optional[int]:
     """Валидация оценки книги (1-10)"""
     try:
@@ -41,16 +54,45 @@ def validate_description(description: str) -> bool:
     """Валидация описания книги"""
     return validate_text_length(description, min_length=0, max_length=1000)
 
+def _strip_tags(text: str) -> str:
+    """Удаление HTML тегов вида <...> за линейное время.
+
+    Результат совпадает с заменой r'<[^>]+>' на пустую строку, но без повторного
+    просмотра хвоста строки от каждого незакрытого '<'.
+    """
+    parts = []
+    pos = 0
+    while True:
+        start = text.find('<', pos)
+        if start == -1:
+            break
+        end = text.find('>', start + 1)
+        if end == -1:
+            # Закрывающих скобок дальше нет, значит и тегов больше нет
+            break
+        if end == start + 1:
+            # '<>' тегом не считается
+            parts.append(text[pos:end])
+            pos = end
+            continue
+        parts.append(text[pos:start])
+        pos = end + 1
+    
+    if not parts:
+        return text
+    parts.append(text[pos:])
+    return ''.join(parts)
+
 def sanitize_text(text: str) -> str:
     """Очистка текста от потенциально опасных символов"""
     if not text:
         return ""
     
     # Удаляем HTML теги
-    text = re.sub(r'<[^>]+>', '', text)
+    text = _strip_tags(text)
     
-    # Удаляем лишние пробелы
-    text = re.sub(r'\s+', ' ', text).strip()
+    # Удаляем лишние пробелы: split() без аргументов режет по любым пробельным символам
+    text = ' '.join(text.split())
     
     return text
 
@@ -66,7 +108,8 @@ def validate_search_query(query: str) -> bool:
         return False
     
     # Проверяем, что есть хотя бы одна буква или цифра
-    if not re.search(r'[a-zA-Zа-яА-Я0-9]', query):
+    # Обычно это первый же символ, поэтому перебор обрывается почти сразу
+    if not any(char in ALNUM_CHARS for char in query):
         return False
     
     return True
@@ -87,20 +130,10 @@ def normalize_author_name(author: str) -> str:
     if not author:
         return "Неизвестный автор"
     
-    # Удаляем лишние пробелы и приводим к правильному регистру
-    author = sanitize_text(author)
-    
-    # Разбиваем на слова и делаем первую букву заглавной
-    words = author.split()
-    normalized_words = []
-    
-    for word in words:
-        if word:
-            # Делаем первую букву заглавной, остальные строчными
-            normalized_word = word[0].upper() + word[1:].lower()
-            normalized_words.append(normalized_word)
+    # Удаляем лишние пробелы и в каждом слове делаем первую букву заглавной, остальные строчными
+    normalized = ' '.join(word.capitalize() for word in sanitize_text(author).split())
     
-    return ' '.join(normalized_words) if normalized_words else "Неизвестный автор"
+    return normalized or "Неизвестный автор"
 
 def normalize_title(title: str) -> str:
     """Нормализация названия книги"""
@@ -119,9 +152,7 @@ def validate_openlibrary_key(key: str) -> bool:
     if not key or not isinstance(key, str):
         return False
     
-    # Паттерн для ключей Open Library (например: /works/OL123456W)
-    pattern = r'^(/works/)?OL\d+[MW]?$'
-    return bool(re.match(pattern, key))
+    return bool(OPENLIBRARY_KEY_PATTERN.match(key))
 
 def extract_numbers_from_text(text: str) -> Optional[int]:
     """Извлечение числа из текста"""
@@ -129,7 +160,7 @@ def extract_numbers_from_text(text: str) -> Optional[int]:
         return None
     
     # Ищем первое число в тексте
-    match = re.search(r'\d+', text)
+    match = NUMBER_PATTERN.search(text)
     if match:
         try:
             return int(match.group())
@@ -144,8 +175,7 @@ def is_valid_url(url: str) -> bool:
         return False
     
     # Простая проверка URL
-    url_pattern = r'^https?://[^\s/$.?#].[^\s]*$'
-    return bool(re.match(url_pattern, url))
+    return bool(URL_PATTERN.match(url))
 
 def clean_description(description: str) -> str:
     """Очистка описания книги"""
@@ -153,11 +183,10 @@ def clean_description(description: str) -> str:
         return ""
     
     # Удаляем HTML теги
-    description = re.sub(r'<[^>]+>', '', description)
+    description = _strip_tags(description)
     
     # Удаляем лишние переносы строк и пробелы
-    description = re.sub(r'\n+', '\n', description)
-    description = re.sub(r'\s+', ' ', description).strip()
+    description = ' '.join(description.split())
     
     # Ограничиваем длину
     if len(description) > 1000: